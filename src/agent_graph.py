@@ -1,56 +1,133 @@
 import os
+import json
+import asyncio
 import datetime
 from typing import TypedDict, List, Dict, Any
 from langgraph.graph import StateGraph, END
-from langchain_groq import ChatGroq
-from langchain_core.messages import SystemMessage, HumanMessage
+from src import prefilter
+from src import prompts
+from src import metrics
+from src import llm_cache
+from src import reply_index
+from src.ledger import get_ledger
+from src.clients import get_llm, GROQ_MODEL
+from src.rate_limiter import call_with_retry, get_groq_limiter, queue_retry, take_due, queued_ids, error_status
 # from src.server import GmailMCPClient # Switched to native
 from typing import Any
 
+# "search": re-run the unread search every cycle (default)
+# "history": incremental sync via Gmail historyId, only returns newly added mail
+GMAIL_SYNC_MODE = os.getenv("GMAIL_SYNC_MODE", "search")
+GMAIL_FETCH_MAX_RESULTS = int(os.getenv("GMAIL_FETCH_MAX_RESULTS", "3")) # Threads looked at per cycle
+# How many LLM calls a node may have in flight at once
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "5"))
+# "single": one classification prompt per email (default)
+# "batch": pack several emails into one prompt, falling back to single calls on bad answers
+FILTER_MODE = os.getenv("FILTER_MODE", "single")
+FILTER_BATCH_SIZE = int(os.getenv("FILTER_BATCH_SIZE", "10")) # Max emails per batch prompt
+FILTER_BATCH_TOKEN_BUDGET = int(os.getenv("FILTER_BATCH_TOKEN_BUDGET", "2500")) # Email content tokens per batch
+
+# Bump these when a prompt changes, so cached LLM answers for the old prompt are not reused
+FILTER_PROMPT_VERSION = "filter-v2"
+REPLY_PROMPT_VERSION = "reply-v3"
+LLM_COMPLETION_TOKENS_ESTIMATE = 300 # Reserved per call in the Groq tokens/minute bucket
+
 # Define State
 class AgentState(TypedDict):
     messages: List[Dict[str, Any]]
     replies_to_send: List[Dict[str, Any]]
     last_checked_time: float # timestamp
+    retry_queue: List[Dict[str, Any]] # Failed items waiting for another try (see rate_limiter)
+    pending_threads: List[Dict[str, Any]] # Drain mode: threads to process instead of searching (see drain.py)
+    backlog: bool # The last search came back full, so more unread mail is probably waiting
+    send_failures: List[Dict[str, Any]] # Replies (or label updates) that failed in the last send step
+    sync_point: Any # History mode: historyId to save once this cycle is done (see commit_sync_point)
+
+# Initialize Groq: get_llm() (src/clients.py) returns the process-wide client
+
+async def invoke_llm(llm, prompt_messages, node="llm", max_tokens=None):
+    """Calls the LLM through the shared Groq rate limiter, retrying rate limits and transient errors.
+
+    Token usage is recorded under `node` (see prompts.USAGE). `max_tokens` caps the completion.
+    """
+    limiter = get_groq_limiter()
+    prompt_tokens = prompts.prompt_tokens(prompt_messages)
+    kwargs = {"max_tokens": max_tokens} if max_tokens else {}
 
-# Initialize Groq
-def get_llm():
-    api_key = os.getenv("GROQ_API_KEY")
-    return ChatGroq(model_name="llama-3.3-70b-versatile", api_key=api_key, temperature=0)
+    async def attempt():
+        await limiter.acquire(prompt_tokens + (max_tokens or LLM_COMPLETION_TOKENS_ESTIMATE))
+        with metrics.span("llm_call", metrics.LLM_CALL_SECONDS, node=node):
+            return await llm.ainvoke(prompt_messages, **kwargs)
+
+    response = await call_with_retry(attempt, name="Groq call", buckets=limiter.buckets)
+    prompts.record_usage(node, response, prompt_tokens)
+    return response
+
+def commit_sync_point(mcp_client, sync_point, retry_queue):
+    """End of a cycle: saves the history sync point fetch_emails got (if any). Returns the state update.
+
+    The retry queue only lives in memory, so while it holds anything the old point is kept:
+    after a restart history lists those messages again (the ledger skips the finished ones).
+    """
+    if sync_point is not None:
+        if retry_queue:
+            print(f"{len(retry_queue)} item(s) waiting for a retry, history sync point not advanced.")
+        else:
+            mcp_client.commit_sync_point(sync_point)
+    return {"sync_point": None}
+
+def _mark(ledger, messages, status):
+    """Counts messages reaching `status` and records it in the ledger (if there is one)."""
+    metrics.MESSAGES.inc(len(messages), status=status)
+    if ledger:
+        ledger.mark(messages, status)
 
 # --- Nodes ---
 
-async def fetch_emails(state: AgentState, mcp_client: Any):
-    """Fetches unread emails from Gmail, filters by time."""
+async def fetch_emails(state: AgentState, mcp_client: Any, ledger=None):
+    """Fetches unread emails from Gmail, filters by time and skips ones the ledger already finished."""
     print("--- Fetching Emails ---")
     
+    # Messages whose classification failed in an earlier cycle get another try now
+    queued = queued_ids(state.get("retry_queue"))
+    due, retry_queue = take_due(state.get("retry_queue"), "filter")
+    retried = [{**entry["item"], "retryAttempts": entry["attempts"]} for entry in due]
+    
+    pending = state.get("pending_threads")
+    backlog = False
+    sync_point = None
+    
+    def with_retries(new_messages):
+        new_ids = {msg['id'] for msg in new_messages}
+        return {
+            "messages": new_messages + [msg for msg in retried if msg['id'] not in new_ids],
+            "retry_queue": retry_queue,
+            "pending_threads": [],
+            "backlog": backlog,
+            "sync_point": sync_point
+        }
+    
     # 1. Get List (search threads)
     # Note: query 'is:unread' + check logic
     try:
-        # We search specifically for unread messages
-        result = await mcp_client.session.call_tool("search_threads", arguments={"query": "is:unread", "maxResults": 3})
-        # MCP Tool result structure: depends on server. content[0].text is normally JSON string or direct data.
-        # We need to parse it. 
-        # Typically MCP returns CallToolResult(content=[TextContent(type='text', text='JSON...'), ...])
-        
-        threads = []
-        if result.content and result.content[0].type == 'text':
-             threads = eval(result.content[0].text) # or json.loads if it's strictly JSON
-             # The result might be a list of dicts. 
-             # Safety: if eval fails or structure is different, we need robust parsing.
-             # Let's assume standard json.
-             import json
-             try:
-                 data = json.loads(result.content[0].text)
-                 threads = data if isinstance(data, list) else data.get('threads', [])
-             except:
-                 # Fallback if it's already a dict/list (mcp python sdk might auto-parse?)
-                 # For now, let's treat it as potentially needing parse.
-                 pass
+        # The native client returns Python data directly (no JSON round trip through call_tool)
+        if pending:
+            # Drain mode already listed the threads for this chunk
+            threads = pending
+        elif GMAIL_SYNC_MODE == "history":
+            # Only threads with messages added since the last sync (one cheap call when idle)
+            # The new sync point is only saved at the end of the cycle (see commit_sync_point).
+            # A resync lists every unread thread of the time window, not just one page.
+            window_start = int(state.get("last_checked_time", 0))
+            threads, history_id = await mcp_client.sync_history(f"is:unread after:{window_start}")
+            sync_point = history_id
+        else:
+            # We search specifically for unread messages
+            threads = await mcp_client.search("is:unread", GMAIL_FETCH_MAX_RESULTS)
 
         if not threads:
             print("No unread threads found.")
-            return {"messages": []}
+            return with_retries([])
 
         # 2. Get Details for each thread (or at least the latest message in it)
         # We need to filter by time > last_checked_time
@@ -60,178 +137,465 @@ async def fetch_emails(state: AgentState, mcp_client: Any):
         last_time = state.get("last_checked_time", 0)
         print(f"DEBUG: Filtering messages after timestamp: {last_time} ({datetime.datetime.fromtimestamp(last_time)})")
 
-        for thread in threads:
-            # We need to fetch the actual message content. 
-            # Tool: `get_thread` usually? Or `get_message`.
-            # If search_threads returns snippet, use that for filtering.
-            # But we need timestamp.
-            
-            # Let's assume we fetch thread details
-            t_id = thread['id']
-            # call get_thread
-            t_result = await mcp_client.session.call_tool("get_thread", arguments={"threadId": t_id})
-            t_data = json.loads(t_result.content[0].text)
-            
-            # Get latest message
-            messages_in_thread = t_data.get('messages', [])
-            if not messages_in_thread: continue
-            
-            latest_msg = messages_in_thread[-1]
+        # Latest message of every thread with batched requests (1 round trip per ~50 threads).
+        # Only metadata is downloaded here; bodies are loaded later for accepted emails only.
+        latest_messages = await mcp_client.get_latest_messages(threads)
+        if sync_point is not None and len(latest_messages) < len(threads):
+            # Some threads failed to load: keep the old sync point so the next cycle lists them again
+            print(f"Loaded {len(latest_messages)}/{len(threads)} thread(s), history sync point not advanced.")
+            sync_point = None
+
+        for latest_msg in latest_messages:
+            t_id = latest_msg['threadId']
             
             # Timestamp check (internalDate is ms)
             msg_time = int(latest_msg.get('internalDate', 0)) / 1000.0
             print(f"DEBUG: Checking Msg ID: {latest_msg['id']}, Time: {msg_time} ({datetime.datetime.fromtimestamp(msg_time)})")
             
-            if msg_time > last_time:
+            # History sync lists each message once (the ledger skips the ones a retried sync point
+            # lists again), so with a ledger the time check is only needed for search mode, where
+            # it would otherwise drop mail that arrived mid-cycle
+            if ledger and ledger.is_done(latest_msg['id']):
+                print(f"DEBUG: Msg ID {latest_msg['id']} already processed ({ledger.status(latest_msg['id'])}), skipping")
+                continue
+            if latest_msg['id'] in queued:
+                # Waiting in the retry queue: it comes back from there, a second copy would mean a second reply
+                print(f"DEBUG: Msg ID {latest_msg['id']} is queued for a retry, skipping")
+                continue
+            
+            if (GMAIL_SYNC_MODE == "history" and ledger) or msg_time > last_time:
+                headers = latest_msg['payload'].get('headers', [])
                 # Add to processing list
                 new_messages.append({
                     "id": latest_msg['id'],
                     "threadId": t_id,
+                    "internalDate": msg_time,
                     "snippet": latest_msg.get('snippet', ''),
-                    "sender": next((h['value'] for h in latest_msg['payload']['headers'] if h['name'] == 'From'), 'Unknown'),
-                    "subject": next((h['value'] for h in latest_msg['payload']['headers'] if h['name'] == 'Subject'), 'No Subject'),
-                    "body": latest_msg.get('snippet', '') # Simplifying: using snippet as body for now
+                    "sender": next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown'),
+                    "subject": next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject'),
+                    "body": latest_msg.get('snippet', ''), # Replaced by the full text in load_bodies
+                    "headers": {h['name']: h['value'] for h in headers} # Used by the prefilter rules
                 })
         
-        return {"messages": new_messages}
+        _mark(ledger, new_messages, "fetched")
+        # A full search page where every thread had new mail: there is probably more beyond it
+        # (already handled threads stay unread, so they must not count)
+        backlog = not pending and GMAIL_SYNC_MODE != "history" \
+            and len(threads) >= GMAIL_FETCH_MAX_RESULTS and len(new_messages) >= len(threads)
+        return with_retries(new_messages)
 
     except Exception as e:
         print(f"Error fetching emails: {e}")
-        return {"messages": []}
+        metrics.ERRORS.inc(where="fetch")
+        sync_point = None
+        return with_retries([])
+
+async def prefilter_emails(state: AgentState, ledger=None):
+    """Cheap local pass: drops obvious automated mail, accepts confident cases, rest goes to the LLM."""
+    print("--- Prefiltering Emails ---")
+    if not prefilter.PREFILTER_ENABLED:
+        return {"messages": state["messages"]}
 
-async def filter_emails(state: AgentState):
+    remaining = []
+    rejected = []
+    for msg in state["messages"]:
+        prefilter.STATS["seen"] += 1
+        decision, reason = prefilter.prefilter_message(msg)
+        if decision == "reject":
+            print(f"Prefilter skipping: {msg['subject']} ({reason})")
+            rejected.append(msg)
+            continue
+        if decision == "accept":
+            print(f"Prefilter accepted: {msg['subject']} ({reason})")
+        remaining.append({**msg, "prefilter": decision})
+
+    _mark(ledger, rejected, "skipped")
+    print(f"Prefilter stats: {prefilter.STATS} (LLM calls saved: {prefilter.llm_calls_saved()})")
+    return {"messages": remaining}
+
+def _parse_json_response(response):
+    """Parses an LLM JSON answer, tolerating markdown code fences."""
+    response = response.strip()
+    # Clean up potential markdown formatting from LLM (e.g. ```json ... ```)
+    if "```" in response:
+        response = response.split("```")[1].strip()
+        if response.startswith("json"):
+            response = response[4:].strip()
+    return json.loads(response)
+
+async def classify_email(llm, msg, semaphore):
+    """Asks the LLM whether one email is a real, mobile-related inquiry."""
+    # Combined Check: Single Prompt to save tokens (instructions are in the shared system prompt)
+    async with semaphore:
+        response = await invoke_llm(llm, prompts.filter_prompt(msg), "filter")
+    return _parse_json_response(response.content)
+
+def make_filter_batches(messages):
+    """Groups messages into batches of at most FILTER_BATCH_SIZE emails / FILTER_BATCH_TOKEN_BUDGET tokens."""
+    batches, current, used = [], [], 0
+    for msg in messages:
+        cost = prompts.count_tokens(prompts.batch_email_block(msg))
+        if current and (len(current) >= FILTER_BATCH_SIZE or used + cost > FILTER_BATCH_TOKEN_BUDGET):
+            batches.append(current)
+            current, used = [], 0
+        current.append(msg)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+async def classify_batch(llm, batch, semaphore):
+    """Classifies several emails with one prompt. Returns {message id: analysis}.
+
+    Only entries that are well-formed are returned; callers retry the missing ids.
+    """
+    async with semaphore:
+        response = await invoke_llm(llm, prompts.filter_batch_prompt(batch), "filter")
+    data = _parse_json_response(response.content)
+    if not isinstance(data, list):
+        raise ValueError("batch answer is not a JSON array")
+
+    expected = {msg['id'] for msg in batch}
+    return {
+        item['id']: item for item in data
+        if isinstance(item, dict) and item.get('id') in expected
+        and 'is_real_human' in item and 'is_mobile_related' in item
+    }
+
+async def classify_emails_batched(llm, messages, semaphore):
+    """Batch-mode classification. Returns one analysis (or Exception) per message, in order."""
+    batches = make_filter_batches(messages)
+    batch_results = await asyncio.gather(
+        *(classify_batch(llm, batch, semaphore) for batch in batches),
+        return_exceptions=True
+    )
+
+    analyses = {}
+    fallback = []
+    for batch, result in zip(batches, batch_results):
+        if isinstance(result, Exception):
+            print(f"Batch classification failed ({result}). Falling back to single calls for {len(batch)} email(s).")
+            fallback.extend(batch)
+            continue
+        analyses.update(result)
+        missing = [msg for msg in batch if msg['id'] not in result]
+        if missing:
+            print(f"Batch answer incomplete. Falling back to single calls for {len(missing)} email(s).")
+            fallback.extend(missing)
+
+    fallback_results = await asyncio.gather(
+        *(classify_email(llm, msg, semaphore) for msg in fallback),
+        return_exceptions=True
+    )
+    for msg, result in zip(fallback, fallback_results):
+        analyses[msg['id']] = result
+
+    print(f"Classified {len(messages)} email(s) with {len(batches)} batch call(s) + {len(fallback)} single call(s)")
+    return [analyses[msg['id']] for msg in messages]
+
+async def filter_emails(state: AgentState, ledger=None):
     """Filters emails: Real Person AND Mobiles Only (Optimized for Tokens)."""
     print("--- Filtering Emails ---")
-    messages = state["messages"]
-    valid_messages = []
+    # Emails the prefilter already accepted skip the LLM
+    valid_messages = [msg for msg in state["messages"] if msg.get("prefilter") == "accept"]
+    messages = [msg for msg in state["messages"] if msg.get("prefilter") != "accept"]
+    if not messages:
+        _mark(ledger, valid_messages, "filtered")
+        return {"messages": valid_messages}
+    usage_before = dict(prompts.USAGE.get("filter", {}))
+    decisions = [] # (msg, accepted) pairs to train the prefilter keyword model
+    rejected_messages = []
+    retry_queue = list(state.get("retry_queue") or [])
     
-    llm = get_llm()
+    # Answers for already-seen content come from the on-disk cache
+    cache = llm_cache.get_cache()
+    cached = {}
+    if cache:
+        for msg in messages:
+            analysis = cache.get(cache.make_key("filter", msg, FILTER_PROMPT_VERSION, GROQ_MODEL))
+            if analysis is not None:
+                cached[msg['id']] = analysis
+        print(f"Filter cache: {len(cached)} hit(s), {len(messages) - len(cached)} miss(es)")
+    to_classify = [msg for msg in messages if msg['id'] not in cached]
+    
+    results = []
+    if to_classify:
+        llm = get_llm()
+        # Classify all emails concurrently, at most LLM_MAX_CONCURRENCY calls in flight
+        semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        if FILTER_MODE == "batch":
+            results = await classify_emails_batched(llm, to_classify, semaphore)
+        else:
+            results = await asyncio.gather(
+                *(classify_email(llm, msg, semaphore) for msg in to_classify),
+                return_exceptions=True # One failing email must not sink the others
+            )
+    fresh = {msg['id']: analysis for msg, analysis in zip(to_classify, results)}
     
+    # Decisions are applied in the original message order
     for msg in messages:
         subject = msg['subject']
-        snippet = msg['snippet']
-        sender = msg['sender']
-        
-        # Combined Check: Single Prompt to save tokens
-        prompt_analysis = f"""
-        You are a smart email filter for a Mobile Store.
-        Analyze this email:
-        Sender: {sender}
-        Subject: {subject}
-        Content: {snippet}
+        analysis = cached.get(msg['id'], fresh.get(msg['id']))
+        if isinstance(analysis, Exception):
+            print(f"Error filtering email '{subject}': {analysis}")
+            metrics.ERRORS.inc(where="filter")
+            queue_retry(retry_queue, "filter", msg, analysis, msg.get("retryAttempts", 0))
+            continue
         
-        Determine two things:
-        1. Is this a REAL email from a human (not marketing/spam/automated)?
-        2. Is the user explicitly asking about mobile phones, buying a phone, or mobile accessories?
+        print(f"DEBUG Analysis for '{subject}': {analysis}")
         
-        Reply strictly in the following JSON format (no markdown, just json):
-        {{
-            "is_real_human": true/false,
-            "is_mobile_related": true/false,
-            "reason": "short reason"
-        }}
-        """
-        try:
-            response = llm.invoke([HumanMessage(content=prompt_analysis)]).content.strip()
-            # Clean up potential markdown formatting from LLM (e.g. ```json ... ```)
-            if "```" in response:
-                response = response.split("```")[1].strip()
-                if response.startswith("json"):
-                    response = response[4:].strip()
-            
-            import json
-            analysis = json.loads(response)
-            
-            print(f"DEBUG Analysis for '{subject}': {analysis}")
-            
-            if analysis.get("is_real_human") and analysis.get("is_mobile_related"):
-                print(f"Accepted: {subject}")
-                valid_messages.append(msg)
-            else:
-                print(f"Skipping: {subject} ({analysis.get('reason')})")
-                
-        except Exception as e:
-            print(f"Error filtering email '{subject}': {e}")
-            continue
+        accepted = bool(analysis.get("is_real_human") and analysis.get("is_mobile_related"))
+        if msg['id'] in fresh:
+            decisions.append((msg, accepted))
+            if cache:
+                cache.set(cache.make_key("filter", msg, FILTER_PROMPT_VERSION, GROQ_MODEL), "filter", analysis)
+        if accepted:
+            print(f"Accepted: {subject}")
+            valid_messages.append(msg)
+        else:
+            print(f"Skipping: {subject} ({analysis.get('reason')})")
+            rejected_messages.append(msg)
 
-    return {"messages": valid_messages}
+    prefilter.record_decisions(decisions)
+    prompts.log_usage("filter", usage_before)
+    # Emails whose classification failed stay "fetched" (and sit in the retry queue)
+    _mark(ledger, valid_messages, "filtered")
+    _mark(ledger, rejected_messages, "skipped")
 
-async def generate_replies(state: AgentState):
-    """Generates replies for valid emails."""
-    print("--- Generating Replies ---")
+    return {"messages": valid_messages, "retry_queue": retry_queue}
+
+async def load_bodies(state: AgentState, mcp_client):
+    """Downloads full bodies, only for the emails that passed filtering."""
+    print("--- Loading Email Bodies ---")
     messages = state["messages"]
+    missing = [msg['id'] for msg in messages if not msg.get('bodyLoaded')]
+    if not missing:
+        return {"messages": messages}
+    try:
+        # Decoded, without quoted history / signatures and capped at BODY_MAX_TOKENS
+        texts = await mcp_client.get_message_bodies(missing)
+    except Exception as e:
+        # Not fatal: the reply is written from the snippet instead
+        print(f"Error loading email bodies: {e}")
+        metrics.ERRORS.inc(where="bodies")
+        texts = {}
+
+    loaded = []
+    for msg in messages:
+        text = texts.get(msg['id'])
+        if text:
+            msg = {**msg, "body": text, "bodyLoaded": True}
+        loaded.append(msg)
+    return {"messages": loaded}
+
+async def generate_reply(llm, msg, semaphore, example=None):
+    """Writes the reply text for one accepted email (guided by a similar answered one, if given)."""
+    # With an example the answer is about as long as the example reply, so it gets a tighter cap
+    max_tokens = 2 * prompts.count_tokens(example['reply']) + 64 if example else None
+    async with semaphore:
+        response = await invoke_llm(llm, prompts.reply_prompt(msg, example), "reply", max_tokens)
+    return response.content.strip()
+
+async def generate_replies(state: AgentState, ledger=None, index=None):
+    """Generates replies for valid emails (reusing answers from the reply `index`, if given)."""
+    print("--- Generating Replies ---")
+    due, retry_queue = take_due(state.get("retry_queue"), "reply")
+    # A message can't be in both (fetch skips queued ids), but never reply to the same one twice
+    current_ids = {msg['id'] for msg in state["messages"]}
+    messages = state["messages"] + [
+        {**entry["item"], "retryAttempts": entry["attempts"]} for entry in due if entry["item"]['id'] not in current_ids
+    ]
     replies = []
+    usage_before = dict(prompts.USAGE.get("reply", {}))
+    
+    cache = llm_cache.get_cache()
+    bodies = {}
+    if cache:
+        for msg in messages:
+            body = cache.get(cache.make_key("reply", msg, REPLY_PROMPT_VERSION, GROQ_MODEL))
+            if body is not None:
+                bodies[msg['id']] = body
+        print(f"Reply cache: {len(bodies)} hit(s), {len(messages) - len(bodies)} miss(es)")
     
-    llm = get_llm()
+    # Questions we already answered: reuse the reply, or pass it along as an example
+    reused, examples = set(), {}
+    if index:
+        for msg in messages:
+            if msg['id'] in bodies:
+                continue
+            inquiry = reply_index.inquiry_text(msg)
+            similarity, entry = index.search(inquiry)
+            # Same wording but another model: at most an example
+            if similarity >= reply_index.REPLY_REUSE_SIMILARITY and reply_index.can_reuse(inquiry, entry):
+                bodies[msg['id']] = reply_index.adapt_reply(entry['reply'], msg['sender'])
+                reused.add(msg['id'])
+            elif reply_index.REPLY_EXAMPLE_SIMILARITY and similarity >= reply_index.REPLY_EXAMPLE_SIMILARITY:
+                examples[msg['id']] = entry
+        if reused or examples:
+            print(f"Reply index: {len(reused)} reply(s) reused, {len(examples)} generated from an example")
+    to_generate = [msg for msg in messages if msg['id'] not in bodies]
+    
+    if to_generate:
+        llm = get_llm()
+        semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        results = await asyncio.gather(
+            *(generate_reply(llm, msg, semaphore, examples.get(msg['id'])) for msg in to_generate),
+            return_exceptions=True
+        )
+        for msg, body in zip(to_generate, results):
+            if isinstance(body, Exception):
+                print(f"Error generating reply for '{msg['subject']}': {body}")
+                metrics.ERRORS.inc(where="reply")
+                queue_retry(retry_queue, "reply", msg, body, msg.get("retryAttempts", 0))
+                continue
+            bodies[msg['id']] = body
+            if cache:
+                cache.set(cache.make_key("reply", msg, REPLY_PROMPT_VERSION, GROQ_MODEL), "reply", body)
     
     for msg in messages:
-        prompt = f"""
-        You are a helpful Mobile Store Owner.
-        A customer sent this inquiry:
-        Subject: {msg['subject']}
-        Message: {msg['snippet']}
-        
-        Write a professional, short, and helpful reply. 
-        Do not include placeholders like [Your Name]. Sign off as 'Mobile Store Team'.
-        """
-        response = llm.invoke([HumanMessage(content=prompt)]).content.strip()
-        
-        replies.append({
+        if msg['id'] not in bodies:
+            continue
+        reply = {
+            "messageId": msg['id'],
             "threadId": msg['threadId'],
             "to": msg['sender'], # Simplification: use sender string, raw string often contains email <email>
             "subject": f"Re: {msg['subject']}",
-            "body": response
-        })
+            "body": bodies[msg['id']]
+        }
+        if index and msg['id'] not in reused:
+            reply["inquiry"] = reply_index.inquiry_text(msg) # Goes into the reply index once sent
+        replies.append(reply)
         
-    return {"replies_to_send": replies}
+    prompts.log_usage("reply", usage_before)
+    _mark(ledger, [msg for msg in messages if msg['id'] in bodies], "replied")
+    return {"replies_to_send": replies, "retry_queue": retry_queue}
 
-async def send_replies(state: AgentState, mcp_client: Any):
-    """Sends the generated replies."""
+async def send_replies(state: AgentState, mcp_client: Any, ledger=None, index=None):
+    """Sends the generated replies (and stores them in the reply `index`, if given)."""
     print("--- Sending Replies ---")
-    replies = state["replies_to_send"]
+    due, retry_queue = take_due(state.get("retry_queue"), "send")
+    current_ids = {reply['messageId'] for reply in state["replies_to_send"]}
+    replies = state["replies_to_send"] + [
+        {**entry["item"], "retryAttempts": entry["attempts"]} for entry in due if entry["item"]['messageId'] not in current_ids
+    ]
     
+    send_failures = []
+    failed, send_errors = [], []
+    
+    outbound = []
     for reply in replies:
         print(f"Sending reply to {reply['to']}")
+        # Clean 'to' address if needed (extract email from "Name <email>")
+        to_addr = reply['to']
+        if "<" in to_addr:
+            to_addr = to_addr.split("<")[1].strip(">")
+        outbound.append({**reply, "to": to_addr})
+
+    # Send all replies concurrently (bounded by GMAIL_SEND_CONCURRENCY)
+    sent_replies, failures = await mcp_client.send_replies_bulk(outbound) if outbound else ([], [])
+    for reply, e in failures:
+        print(f"Failed to send reply to {reply['to']}: {e}")
+        metrics.ERRORS.inc(where="send")
+        send_failures.append({
+            "stage": "send", "messageId": reply['messageId'], "threadId": reply['threadId'],
+            "to": reply['to'], "status": error_status(e), "error": str(e)[:200]
+        })
+        # Only re-queue when Gmail surely rejected the message, never risk a double reply.
+        # Everything else (and a retry that gave up) is final, so later fetches skip it too.
+        entry = {"id": reply['messageId'], "threadId": reply['threadId']}
+        if error_status(e) in (429, 503) and queue_retry(retry_queue, "send", reply, e, reply.get("retryAttempts", 0)):
+            failed.append(entry)
+        else:
+            send_errors.append(entry)
+    sent = [{"id": reply['messageId'], "threadId": reply['threadId']} for reply in sent_replies]
+    # Record the outcome first: nothing after this point may cause a second reply
+    _mark(ledger, sent, "sent")
+    _mark(ledger, failed, "failed")
+    _mark(ledger, send_errors, "send_error")
+    
+    if index:
         try:
-            # Clean 'to' address if needed (extract email from "Name <email>")
-            to_addr = reply['to']
-            if "<" in to_addr:
-                to_addr = to_addr.split("<")[1].strip(">")
-                
-            await mcp_client.send_reply(
-                to=to_addr,
-                subject=reply['subject'],
-                body=reply['body'],
-                thread_id=reply['threadId']
-            )
+            added = index.add([(reply['inquiry'], reply['body']) for reply in sent_replies if reply.get('inquiry')])
+            if added:
+                print(f"Reply index: {added} new answered inquiry(s) stored ({len(index.entries)} total)")
         except Exception as e:
-            print(f"Failed to send reply to {reply['to']}: {e}")
+            # Best effort: the replies went out, the index just misses them
+            print(f"Could not update the reply index: {e}")
+            metrics.ERRORS.inc(where="reply_index")
+
+    # Answered emails: mark read + label in bulk, so they stop showing up in the unread search
+    if sent:
+        try:
+            await mcp_client.mark_replied([msg['id'] for msg in sent])
+        except Exception as e:
+            # The replies did go out; the ledger still keeps them from being answered twice
+            print(f"Could not mark {len(sent)} replied email(s) as read: {e}")
+            metrics.ERRORS.inc(where="mark_replied")
+            send_failures.extend({
+                "stage": "mark_replied", "messageId": msg['id'], "threadId": msg['threadId'],
+                "status": error_status(e), "error": str(e)[:200]
+            } for msg in sent)
             
-    # Update timestamp to now to avoid duplicate processing in next cycle
-    # (In a real app, track IDs, but time is okay for simple logic)
+    if ledger:
+        # The ledger tracks exactly which messages are done, so the time window stays put
+        # (moving it to "now" would drop mail that arrived while this cycle was running)
+        return {"messages": [], "replies_to_send": [], "retry_queue": retry_queue, "send_failures": send_failures}
+    
+    # No ledger: update timestamp to now to avoid duplicate processing in next cycle
     import time
-    return {"last_checked_time": time.time(), "messages": [], "replies_to_send": []}
+    return {
+        "last_checked_time": time.time(), "messages": [], "replies_to_send": [],
+        "retry_queue": retry_queue, "send_failures": send_failures
+    }
 
 # --- Graph Construction ---
-def create_graph(mcp_client):
+def create_graph(mcp_client, ledger=None, index=None):
     workflow = StateGraph(AgentState)
+    if ledger is None:
+        ledger = get_ledger()
+    if index is None:
+        index = reply_index.get_index()
     
-    # We need to wrap nodes to pass mcp_client
+    # We need to wrap nodes to pass mcp_client and the ledger (and to time them)
     async def fetch_node(state):
-        return await fetch_emails(state, mcp_client)
+        with metrics.span("node", metrics.NODE_SECONDS, node="fetch"):
+            return await fetch_emails(state, mcp_client, ledger)
+        
+    async def prefilter_node(state):
+        with metrics.span("node", metrics.NODE_SECONDS, node="prefilter"):
+            return await prefilter_emails(state, ledger)
+        
+    async def filter_node(state):
+        with metrics.span("node", metrics.NODE_SECONDS, node="filter"):
+            return await filter_emails(state, ledger)
+        
+    async def bodies_node(state):
+        with metrics.span("node", metrics.NODE_SECONDS, node="bodies"):
+            return await load_bodies(state, mcp_client)
+        
+    async def reply_node(state):
+        with metrics.span("node", metrics.NODE_SECONDS, node="reply"):
+            return await generate_replies(state, ledger, index)
         
     async def send_node(state):
-        return await send_replies(state, mcp_client)
+        with metrics.span("node", metrics.NODE_SECONDS, node="send"):
+            result = await send_replies(state, mcp_client, ledger, index)
+        # Last node: everything fetched in this cycle went through, so the sync point can move
+        return {**result, **commit_sync_point(mcp_client, state.get("sync_point"), result["retry_queue"])}
 
     workflow.add_node("fetch", fetch_node)
-    workflow.add_node("filter", filter_emails)
-    workflow.add_node("reply", generate_replies)
+    workflow.add_node("prefilter", prefilter_node)
+    workflow.add_node("filter", filter_node)
+    workflow.add_node("bodies", bodies_node)
+    workflow.add_node("reply", reply_node)
     workflow.add_node("send", send_node)
     
     workflow.set_entry_point("fetch")
     
-    workflow.add_edge("fetch", "filter")
-    workflow.add_edge("filter", "reply")
+    workflow.add_edge("fetch", "prefilter")
+    workflow.add_edge("prefilter", "filter")
+    workflow.add_edge("filter", "bodies")
+    workflow.add_edge("bodies", "reply")
     workflow.add_edge("reply", "send")
     workflow.add_edge("send", END)
     
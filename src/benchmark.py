@@ -0,0 +1,477 @@
+import os
+import sys
+import json
+import time
+import random
+import base64
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import httplib2
+from googleapiclient.errors import HttpError
+from langchain_core.messages import AIMessage
+
+# Offline benchmark: runs the real agent (create_graph or the streaming pipeline, the real
+# GmailNativeClient with its batching / retries / rate limits) against a fake Gmail API and
+# a fake chat model. No Google account, no Groq key, no network.
+#
+# Usage:  python -m src.benchmark --threads 10000 --batch 100 --gmail-latency 0.05 --llm-token-latency 0.002
+#         python -m src.benchmark --json result.json --compare baseline.json   (exit code 1 on a regression)
+#
+# Every cycle "delivers" --batch new threads to the fake mailbox and runs one agent cycle.
+# All state files (ledger, sync state, prefilter model) go to a temporary directory.
+
+PHONES = ["iPhone 15", "Galaxy S24", "Pixel 8", "Redmi Note 13", "OnePlus 12"]
+ACCESSORIES = ["charger", "phone case", "screen protector", "earbuds"]
+OTHER_TOPICS = ["the meeting tomorrow", "your invoice", "the lunch plans", "the quarterly report"]
+
+class FakeServer:
+    """A synthetic mailbox plus call accounting, latency and error injection."""
+
+    def __init__(self, threads, messages_per_thread=1, latency=0.05, error_rate=0.0, body_size=800, seed=1):
+        self.total_threads = threads
+        self.messages_per_thread = messages_per_thread
+        self.latency = latency
+        self.error_rate = error_rate
+        self.body_size = body_size
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.delivered = [] # thread numbers, oldest first
+        self.delivered_at = {}
+        self.history = [] # (history id, thread number)
+        self.unread = set()
+        self.sent = []
+        self.labels = {} # label id -> name
+        self.http_requests = 0
+        self.api_calls = {}
+
+    # --- Mailbox ---
+
+    def deliver(self, count):
+        """Adds the next `count` synthetic threads (with fresh timestamps). Returns how many were added."""
+        start = len(self.delivered)
+        now_ms = int(time.time() * 1000)
+        for n in range(start, min(start + count, self.total_threads)):
+            self.delivered.append(n)
+            self.delivered_at[n] = now_ms
+            self.unread.add(n)
+            self.history.append((len(self.history) + 1, n))
+        return len(self.delivered) - start
+
+    def _kind(self, n):
+        rng = random.Random(self.seed * 1000003 + n)
+        roll = rng.random()
+        return ("customer" if roll < 0.4 else "newsletter" if roll < 0.8 else "other"), rng
+
+    def _headers(self, n, m):
+        kind, rng = self._kind(n)
+        if kind == "customer":
+            product = rng.choice(PHONES + ACCESSORIES)
+            headers = {"From": f"Customer {n} <customer{n}@example.com>", "Subject": f"Question about the {product} (#{n})"}
+        elif kind == "newsletter":
+            headers = {"From": f"Shop {n % 50} <news@shop{n % 50}.example>", "Subject": f"Weekly deals #{n}",
+                       "List-Unsubscribe": f"<mailto:unsubscribe{n}@shop.example>"}
+        else:
+            headers = {"From": f"Colleague {n} <colleague{n}@example.com>", "Subject": f"About {rng.choice(OTHER_TOPICS)} ({n})"}
+        headers["Message-ID"] = f"<m{n}.{m}@example.com>"
+        return [{"name": name, "value": value} for name, value in headers.items()]
+
+    def _text(self, n):
+        kind, rng = self._kind(n)
+        if kind == "customer":
+            first = f"Hi, do you have the {rng.choice(PHONES)} in stock, and what does a {rng.choice(ACCESSORIES)} cost? Order ref {n}."
+        elif kind == "newsletter":
+            first = f"This week only: big discounts on everything. Issue {n}."
+        else:
+            first = f"Hello, can we talk about {rng.choice(OTHER_TOPICS)} today? Ref {n}."
+        filler = " Kind regards and thanks in advance." * (self.body_size // 36)
+        return first + filler + "\n\nOn Mon, 1 Jan 2024 at 10:00, Store <store@example.com> wrote:\n> Earlier message\n"
+
+    def message(self, n, m, profile):
+        msg = {
+            "id": f"m{n}-{m}", "threadId": f"t{n}",
+            "internalDate": str(self.delivered_at.get(n, 0) - (self.messages_per_thread - 1 - m) * 60000),
+            "snippet": self._text(n)[:160],
+        }
+        if profile == "full":
+            data = base64.urlsafe_b64encode(self._text(n).encode()).decode().rstrip("=")
+            msg["payload"] = {"mimeType": "multipart/mixed", "headers": self._headers(n, m), "parts": [
+                {"mimeType": "text/plain", "headers": [{"name": "Content-Type", "value": "text/plain; charset=UTF-8"}],
+                 "body": {"data": data, "size": len(data)}},
+                {"mimeType": "application/pdf", "filename": "catalog.pdf", "body": {"attachmentId": f"a{n}", "size": 250000}},
+            ]}
+        else:
+            msg["payload"] = {"headers": self._headers(n, m)}
+        return msg
+
+    def thread(self, n, profile):
+        return {"id": f"t{n}", "messages": [self.message(n, m, profile) for m in range(self.messages_per_thread)]}
+
+    @staticmethod
+    def number(item_id):
+        return int(item_id[1:].split("-")[0])
+
+    # --- Calls ---
+
+    def maybe_fail(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            status = self.random.choice([429, 500, 503])
+            raise HttpError(httplib2.Response({"status": status, "retry-after": "0"}), b'{"error": "injected"}')
+
+    def count_call(self, method_id):
+        self.api_calls[method_id] = self.api_calls.get(method_id, 0) + 1
+
+    def round_trip(self):
+        self.http_requests += 1
+        if self.latency:
+            time.sleep(self.latency * self.random.uniform(0.8, 1.2)) # Runs on the client's worker threads
+
+class FakeRequest:
+    def __init__(self, server, method_id, handler):
+        self.server = server
+        self.methodId = method_id
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        self.server.round_trip()
+        self.server.count_call(self.methodId)
+        self.server.maybe_fail()
+        return self.handler()
+
+class FakeBatch:
+    """One HTTP round trip, per-item results and errors, like BatchHttpRequest."""
+
+    def __init__(self, server, callback):
+        self.server = server
+        self.callback = callback
+        self._requests = {} # Same attribute as BatchHttpRequest (used for quota units)
+
+    def add(self, request, request_id=None):
+        self._requests[request_id or str(len(self._requests))] = request
+
+    def execute(self, http=None):
+        self.server.round_trip()
+        for request_id, request in self._requests.items():
+            self.server.count_call(request.methodId)
+            try:
+                self.server.maybe_fail()
+                response, error = request.handler(), None
+            except HttpError as e:
+                response, error = None, e
+            self.callback(request_id, response, error)
+
+class FakeGmailService:
+    """Stands in for `build('gmail', 'v1')`: users().threads()/messages()/labels()/history()/getProfile()."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def users(self):
+        return self
+
+    def threads(self):
+        return _Threads(self.server)
+
+    def messages(self):
+        return _Messages(self.server)
+
+    def labels(self):
+        return _Labels(self.server)
+
+    def history(self):
+        return _History(self.server)
+
+    def getProfile(self, userId):
+        return FakeRequest(self.server, "gmail.users.getProfile", lambda: {"historyId": str(len(self.server.history))})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.server, callback)
+
+def _unread_page(server, max_results, page_token):
+    """One page of unread thread numbers, newest first.
+
+    Page tokens are cursors (the last thread returned), so threads that get read
+    meanwhile do not shift later pages.
+    """
+    limit = max_results or 100
+    before = int(page_token) if page_token else None
+    page, more = [], False
+    for n in reversed(server.delivered):
+        if n not in server.unread or (before is not None and n >= before):
+            continue
+        if len(page) == limit:
+            more = True
+            break
+        page.append(n)
+    return page, (str(page[-1]) if more else None)
+
+def _list_response(key, items, next_token):
+    response = {key: items}
+    if next_token:
+        response["nextPageToken"] = next_token
+    return response
+
+class _Threads:
+    def __init__(self, server):
+        self.server = server
+
+    def list(self, userId, q=None, maxResults=None, pageToken=None, **kwargs):
+        def handler():
+            page, next_token = _unread_page(self.server, maxResults, pageToken)
+            return _list_response("threads", [{"id": f"t{n}"} for n in page], next_token)
+        return FakeRequest(self.server, "gmail.users.threads.list", handler)
+
+    def get(self, userId, id, format="full", **kwargs):
+        return FakeRequest(self.server, "gmail.users.threads.get", lambda: self.server.thread(self.server.number(id), format))
+
+class _Messages:
+    def __init__(self, server):
+        self.server = server
+
+    def list(self, userId, q=None, maxResults=None, pageToken=None, **kwargs):
+        last = self.server.messages_per_thread - 1
+        def handler():
+            page, next_token = _unread_page(self.server, maxResults, pageToken)
+            return _list_response("messages", [{"id": f"m{n}-{last}", "threadId": f"t{n}"} for n in page], next_token)
+        return FakeRequest(self.server, "gmail.users.messages.list", handler)
+
+    def get(self, userId, id, format="full", **kwargs):
+        n, m = (int(part) for part in id[1:].split("-"))
+        return FakeRequest(self.server, "gmail.users.messages.get", lambda: self.server.message(n, m, format))
+
+    def send(self, userId, body):
+        def handler():
+            self.server.sent.append(self.server.number(body["threadId"]))
+            return {"id": f"s{len(self.server.sent)}", "threadId": body["threadId"]}
+        return FakeRequest(self.server, "gmail.users.messages.send", handler)
+
+    def batchModify(self, userId, body):
+        def handler():
+            if "UNREAD" in body.get("removeLabelIds", []):
+                self.server.unread.difference_update(map(self.server.number, body["ids"]))
+            return {}
+        return FakeRequest(self.server, "gmail.users.messages.batchModify", handler)
+
+class _Labels:
+    def __init__(self, server):
+        self.server = server
+
+    def list(self, userId, **kwargs):
+        return FakeRequest(self.server, "gmail.users.labels.list", lambda: {
+            "labels": [{"id": label_id, "name": name} for label_id, name in self.server.labels.items()]
+        })
+
+    def create(self, userId, body):
+        def handler():
+            label_id = f"Label_{len(self.server.labels) + 1}"
+            self.server.labels[label_id] = body["name"]
+            return {"id": label_id, "name": body["name"]}
+        return FakeRequest(self.server, "gmail.users.labels.create", handler)
+
+class _History:
+    def __init__(self, server):
+        self.server = server
+
+    def list(self, userId, startHistoryId, pageToken=None, maxResults=500, **kwargs):
+        def handler():
+            start = int(pageToken or startHistoryId) # History ids are list positions here
+            records = self.server.history[start:start + maxResults]
+            response = {"historyId": str(len(self.server.history)), "history": [
+                {"id": str(h_id), "messagesAdded": [{"message": {
+                    "id": f"m{n}-{self.server.messages_per_thread - 1}", "threadId": f"t{n}"
+                }}]} for h_id, n in records
+            ]}
+            if start + maxResults < len(self.server.history):
+                response["nextPageToken"] = str(start + maxResults)
+            return response
+        return FakeRequest(self.server, "gmail.users.history.list", handler)
+
+class FakeChatModel:
+    """Deterministic stand-in for ChatGroq: rule-based answers, latency proportional to output tokens."""
+
+    def __init__(self, latency=0.2, token_latency=0.002):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = 0
+
+    @staticmethod
+    def _analysis(block):
+        text = block.lower()
+        mobile = any(word in text for word in ["phone", "iphone", "galaxy", "pixel", "charger", "earbuds", "redmi", "oneplus"])
+        human = "news@" not in text and "deals" not in text
+        return {"is_real_human": human, "is_mobile_related": mobile, "reason": "benchmark rule"}
+
+    async def ainvoke(self, messages, **kwargs):
+        from src import prompts
+        self.calls += 1
+        system, content = messages[0].content, messages[-1].content
+        if system == prompts.REPLY_SYSTEM_PROMPT:
+            answer = "Thank you for your message! Yes, it is in stock and you can order it in our store today.\n\nMobile Store Team"
+        elif system == prompts.FILTER_BATCH_SYSTEM_PROMPT:
+            items = []
+            for block in content.split("\n\n["):
+                email_id, _, rest = block.lstrip("[").partition("]")
+                items.append({"id": email_id, **self._analysis(rest)})
+            answer = json.dumps(items)
+        else:
+            answer = json.dumps(self._analysis(content))
+        prompt_tokens = prompts.prompt_tokens(messages)
+        completion_tokens = prompts.count_tokens(answer)
+        await asyncio.sleep(self.latency + self.token_latency * completion_tokens)
+        return AIMessage(content=answer, usage_metadata={
+            "input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens
+        })
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1) # bytes on macOS, KB on Linux
+
+async def run_benchmark(args):
+    # Imported here: the settings above are passed through environment variables
+    from src import clients, rate_limiter, prompts
+    from src.gmail_client_native import GmailNativeClient
+    from src.agent_graph import create_graph
+    from src.ledger import get_ledger
+    from src.pipeline import run_streaming_cycle
+
+    server = FakeServer(args.threads, args.messages_per_thread, args.gmail_latency, args.error_rate, args.body_size, args.seed)
+    llm = FakeChatModel(args.llm_latency, args.llm_token_latency)
+    clients.set_llm(llm)
+    client = GmailNativeClient(max_concurrency=args.gmail_concurrency)
+    client.service = FakeGmailService(server)
+    if not args.real_limits:
+        # Measure the agent, not our own quota pacing
+        client._quota = rate_limiter.TokenBucket(1e9)
+        rate_limiter._groq_limiter = rate_limiter.GroqLimiter(1e9, 1e12)
+
+    ledger = get_ledger()
+    graph = create_graph(client, ledger)
+    state = {"messages": [], "replies_to_send": [], "last_checked_time": time.time() - 60, "retry_queue": []}
+
+    latencies = []
+    started = time.time()
+    while server.deliver(args.batch):
+        cycle_started = time.time()
+        if args.mode == "stream":
+            new_state = await run_streaming_cycle(client, state, ledger)
+        else:
+            new_state = await graph.ainvoke(state)
+        latencies.append(time.time() - cycle_started)
+        state["last_checked_time"] = new_state.get("last_checked_time", state["last_checked_time"])
+        state["retry_queue"] = new_state.get("retry_queue", state["retry_queue"])
+    elapsed = time.time() - started
+    await client.close()
+
+    messages = len(server.delivered)
+    api_calls = sum(server.api_calls.values())
+    return {
+        "threads": messages,
+        "cycles": len(latencies),
+        "replies_sent": len(server.sent),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(messages / elapsed, 2) if elapsed else None,
+        "cycle_p50_seconds": round(percentile(latencies, 0.5), 4),
+        "cycle_p99_seconds": round(percentile(latencies, 0.99), 4),
+        "gmail_http_requests": server.http_requests,
+        "gmail_api_calls": api_calls,
+        "gmail_api_calls_per_message": round(api_calls / messages, 3) if messages else None,
+        "gmail_calls_by_method": server.api_calls,
+        "llm_calls": llm.calls,
+        "llm_calls_per_message": round(llm.calls / messages, 3) if messages else None,
+        "llm_tokens": {node: stats["prompt_tokens"] + stats["completion_tokens"] for node, stats in prompts.USAGE.items()},
+        "peak_memory_mb": peak_memory_mb(),
+        "python_peak_memory_mb": round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1) if tracemalloc.is_tracing() else None,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput / latency benchmark for the mail agent.")
+    parser.add_argument("--threads", type=int, default=1000, help="Synthetic threads in the mailbox (10 - 100000)")
+    parser.add_argument("--batch", type=int, default=50, help="New threads delivered (and fetched) per cycle")
+    parser.add_argument("--messages-per-thread", type=int, default=1)
+    parser.add_argument("--body-size", type=int, default=800, help="Approximate body length in characters")
+    parser.add_argument("--mode", choices=["graph", "stream"], default="graph")
+    parser.add_argument("--sync-mode", choices=["search", "history"], default="search")
+    parser.add_argument("--fetch-profile", choices=["metadata", "latest", "full"], default="metadata")
+    parser.add_argument("--filter-mode", choices=["single", "batch"], default="single")
+    parser.add_argument("--no-ledger", action="store_true", help="Run without the processed-message ledger")
+    parser.add_argument("--gmail-latency", type=float, default=0.05, help="Seconds per Gmail HTTP round trip")
+    parser.add_argument("--gmail-concurrency", type=int, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Gmail calls failing with 429/5xx")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Fixed seconds per LLM call")
+    parser.add_argument("--llm-token-latency", type=float, default=0.002, help="Seconds per completion token")
+    parser.add_argument("--reply-index", action="store_true", help="Reuse answers from the reply index (src/reply_index.py)")
+    parser.add_argument("--real-limits", action="store_true", help="Keep the Gmail quota / Groq rate limits")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report Python heap peak (slower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="Show the agent's own output")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline results JSON: exit 1 if throughput dropped too much")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed throughput drop vs. baseline (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix="mail-agent-bench-")
+    os.chdir(workdir) # Ledger, sync state, prefilter model and cache files stay out of the project
+    os.environ.update({
+        "GMAIL_SYNC_MODE": args.sync_mode,
+        "GMAIL_FETCH_PROFILE": args.fetch_profile,
+        "GMAIL_FETCH_MAX_RESULTS": str(args.batch),
+        "FILTER_MODE": args.filter_mode,
+        "LEDGER_ENABLED": "false" if args.no_ledger else "true",
+        "LLM_CACHE_ENABLED": "false", # Every synthetic email is new anyway
+        "AGENT_EXECUTION_MODE": args.mode,
+        "REPLY_INDEX_ENABLED": "true" if args.reply_index else "false",
+    })
+    if args.trace_memory:
+        tracemalloc.start()
+
+    # The agent prints a lot per cycle; keep the benchmark output readable
+    real_stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        if sys.stdout is not real_stdout:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+
+    print(f"Benchmark ({args.mode}, {args.sync_mode} sync, {args.fetch_profile} profile, {args.filter_mode} filter), work dir {workdir}")
+    print(f"  {results['threads']} thread(s) in {results['cycles']} cycle(s), {results['replies_sent']} reply(s) sent, {results['seconds']}s")
+    print(f"  Throughput:     {results['messages_per_second']} messages/s")
+    print(f"  Cycle latency:  p50 {results['cycle_p50_seconds']}s, p99 {results['cycle_p99_seconds']}s")
+    print(f"  Gmail:          {results['gmail_http_requests']} HTTP requests, {results['gmail_api_calls_per_message']} API calls/message")
+    print(f"  LLM:            {results['llm_calls']} calls, {results['llm_calls_per_message']} calls/message, tokens {results['llm_tokens']}")
+    print(f"  Peak memory:    {results['peak_memory_mb']} MB" +
+          (f" (Python heap {results['python_peak_memory_mb']} MB)" if results['python_peak_memory_mb'] is not None else ""))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        floor = baseline["messages_per_second"] * (1 - args.max_regression)
+        if results["messages_per_second"] < floor:
+            print(f"REGRESSION: {results['messages_per_second']} messages/s < {floor:.2f} (baseline {baseline['messages_per_second']})")
+            return 1
+        print(f"OK: within {args.max_regression:.0%} of baseline ({baseline['messages_per_second']} messages/s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
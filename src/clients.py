@@ -0,0 +1,65 @@
+import os
+import httpx
+from langchain_groq import ChatGroq
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from src.credentials import close_credentials
+
+# Process-wide client lifecycle.
+# Creating a ChatGroq (and its HTTP client) or parsing the Gmail discovery document is
+# not free, so each is done once per process and shared by every node, cycle and mailbox.
+
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+
+_llm = None
+_llm_http_client = None
+_gmail_discovery_doc = None
+
+def get_llm():
+    """The shared chat model. Its async HTTP client keeps connections alive between calls."""
+    global _llm, _llm_http_client
+    if _llm is None:
+        _llm_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_SECONDS
+            ),
+            timeout=LLM_TIMEOUT_SECONDS
+        )
+        _llm = ChatGroq(
+            model_name=GROQ_MODEL,
+            api_key=os.getenv("GROQ_API_KEY"),
+            temperature=0,
+            # Retries are handled by invoke_llm (shared rate limits + backoff), not by the SDK
+            max_retries=0,
+            http_async_client=_llm_http_client
+        )
+    return _llm
+
+def set_llm(llm):
+    """Replaces the shared chat model (e.g. with a fake one for benchmarks)."""
+    global _llm
+    _llm = llm
+
+def build_gmail_service(creds):
+    """Builds a Gmail service from a discovery document that is parsed only once per process."""
+    global _gmail_discovery_doc
+    if _gmail_discovery_doc is None:
+        _gmail_discovery_doc = get_static_doc('gmail', 'v1')
+    if _gmail_discovery_doc is None:
+        # Old googleapiclient without bundled documents: fetch it as usual
+        return build('gmail', 'v1', credentials=creds)
+    return build_from_document(_gmail_discovery_doc, credentials=creds)
+
+async def close_clients():
+    """Closes the shared HTTP connections and stops the token refreshes. Call once on shutdown."""
+    global _llm, _llm_http_client
+    await close_credentials()
+    if _llm_http_client is not None:
+        await _llm_http_client.aclose()
+    _llm = None
+    _llm_http_client = None
@@ -0,0 +1,113 @@
+import os
+import asyncio
+import threading
+from datetime import datetime, timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+# OAuth credentials, shared per token file.
+# Every client using the same token file gets the same Credentials object, so the file is
+# read once and a refresh is done once for all of them. The access token is refreshed by a
+# background task before it expires (on a worker thread, the loop never waits for it) and
+# written back to the token file, so a restart does not have to refresh again.
+# Without this, google-auth refreshes inside whichever Gmail request hits the expiry.
+
+# Refresh this many seconds before expiry. Keep it above google-auth's own threshold
+# (~4 minutes), otherwise requests start refreshing by themselves first.
+CREDENTIAL_REFRESH_MARGIN_SECONDS = float(os.getenv("CREDENTIAL_REFRESH_MARGIN_SECONDS", "600"))
+CREDENTIAL_RETRY_SECONDS = 60 # Wait after a failed background refresh
+
+_managers = {} # absolute token file path -> CredentialManager
+
+def _seconds_left(creds):
+    if creds.expiry is None:
+        return None
+    # google-auth keeps expiry as a naive UTC datetime
+    return (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+
+class CredentialManager:
+    def __init__(self, token_file, scopes):
+        self.token_file = token_file
+        self.creds = None
+        self._lock = threading.Lock() # Refreshes run on worker threads
+        self._task = None
+        self._saved_token = None
+        try:
+            self.creds = Credentials.from_authorized_user_file(token_file, scopes)
+            self._saved_token = self.creds.token
+        except ValueError:
+            print(f"Token file {token_file} format mismatch. Re-run auth_manual.py or debug_auth.py")
+
+    def _needs_refresh(self):
+        seconds_left = _seconds_left(self.creds)
+        return not self.creds.token or (seconds_left is not None and seconds_left <= CREDENTIAL_REFRESH_MARGIN_SECONDS)
+
+    def _refresh(self):
+        with self._lock:
+            if self._needs_refresh(): # Another thread may have just done it
+                self.creds.refresh(Request())
+            if self.creds.token != self._saved_token:
+                self._save()
+
+    def _save(self):
+        # Temp file + rename, so a crash never leaves a half-written token file
+        tmp_file = self.token_file + '.tmp'
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.creds.to_json())
+        os.replace(tmp_file, self.token_file)
+        self._saved_token = self.creds.token
+
+    async def refresh(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._refresh)
+
+    async def start(self):
+        """Refreshes now if the token is (nearly) expired, then keeps it fresh in the background."""
+        if not self.creds or not self.creds.refresh_token:
+            return
+        if self._needs_refresh():
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep the creds: if it's a network error, the background task tries again
+                print(f"Warning: Token refresh failed (Network issue?): {e}")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            seconds_left = _seconds_left(self.creds)
+            if seconds_left is None:
+                return # Token without expiry, nothing to do
+            delay = seconds_left - CREDENTIAL_REFRESH_MARGIN_SECONDS
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                # Also persists a token that a request refreshed by itself meanwhile
+                await self.refresh()
+                print(f"Access token for {os.path.basename(self.token_file)} refreshed in the background.")
+            except Exception as e:
+                print(f"Warning: Background token refresh failed, retrying in {CREDENTIAL_RETRY_SECONDS}s: {e}")
+                await asyncio.sleep(CREDENTIAL_RETRY_SECONDS)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+async def get_credentials(token_file, scopes):
+    """The shared, auto-refreshing credentials for `token_file` (None if the file is missing or invalid)."""
+    path = os.path.abspath(token_file)
+    if path not in _managers:
+        if not os.path.exists(path):
+            return None
+        _managers[path] = CredentialManager(path, scopes)
+    manager = _managers[path]
+    await manager.start()
+    return manager.creds
+
+async def close_credentials():
+    """Stops the background refreshes. Call once on shutdown."""
+    for manager in _managers.values():
+        await manager.stop()
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+
+# Backlog drain mode.
+# A normal cycle only looks at GMAIL_FETCH_MAX_RESULTS unread threads, which is fine when
+# mail trickles in but takes days to work through thousands of unread emails (first
+# deployment, long outage). Drain mode pages through ALL matching threads and runs them
+# through the normal cycle in bounded chunks, saving a checkpoint after every chunk so a
+# restart continues where it stopped. Once the backlog is gone, main.py goes back to its
+# normal poll/push loop.
+
+# "off": never drain
+# "startup": drain once when the agent starts
+# "auto": drain at startup and whenever a normal cycle finds a full page of unread mail
+DRAIN_MODE = os.getenv("AGENT_DRAIN_MODE", "off")
+DRAIN_ORDER = os.getenv("DRAIN_ORDER", "newest") # "newest" first or "oldest" first
+DRAIN_CHUNK_SIZE = min(int(os.getenv("DRAIN_CHUNK_SIZE", "100")), 500) # Threads per cycle (Gmail lists max 500)
+DRAIN_MAX_AGE_DAYS = float(os.getenv("DRAIN_MAX_AGE_DAYS", "7")) # Unread mail older than this is left alone
+DRAIN_CHECKPOINT_FILE = os.getenv("DRAIN_CHECKPOINT_FILE", "drain_checkpoint.json")
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read drain checkpoint {path}: {e}")
+        return None
+
+def _save_json(path, data):
+    # Temp file + rename, so a crash never leaves a half-written checkpoint
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, path)
+
+def _clear_checkpoint(path):
+    for name in (path, path + '.threads'):
+        if os.path.exists(name):
+            os.remove(name)
+
+async def iter_chunks(client, query, order, chunk_size, checkpoint, checkpoint_file):
+    """Async generator of (threads, cursor) chunks. `cursor` is what the checkpoint stores once the chunk is done.
+
+    Newest first streams the pages as Gmail returns them (cursor = next page token).
+    Oldest first has to list every id before it can start (only ids, a few MB for 100k
+    threads); the list is saved next to the checkpoint and the cursor is a position in it.
+    """
+    if order == "oldest":
+        threads_file = checkpoint_file + '.threads'
+        if checkpoint and os.path.exists(threads_file):
+            with open(threads_file, 'r') as f:
+                threads = json.load(f)
+        else:
+            threads = []
+            async for page, _ in client.iter_search_pages(query, 500):
+                threads.extend(page)
+            threads.reverse()
+            _save_json(threads_file, threads)
+        start = (checkpoint.get('cursor') or 0) if checkpoint else 0
+        for position in range(start, len(threads), chunk_size):
+            yield threads[position:position + chunk_size], position + chunk_size
+    else:
+        page_token = checkpoint.get('cursor') if checkpoint else None
+        async for page, next_token in client.iter_search_pages(query, chunk_size, page_token):
+            yield page, next_token
+
+async def drain_backlog(run_cycle, graph, client, state, ledger=None,
+                        order=DRAIN_ORDER, chunk_size=DRAIN_CHUNK_SIZE, checkpoint_file=DRAIN_CHECKPOINT_FILE):
+    """Processes every unread thread (up to DRAIN_MAX_AGE_DAYS old) in chunks. Returns the updated state."""
+    checkpoint = _load_checkpoint(checkpoint_file)
+    if checkpoint and checkpoint.get('order') == order:
+        query = checkpoint['query']
+        window_start = checkpoint['window_start']
+        print(f"Resuming backlog drain ({order} first) after {checkpoint['processed']} thread(s).")
+    else:
+        checkpoint = None
+        # Without a ledger the time window is the only protection against double replies
+        window_start = time.time() - DRAIN_MAX_AGE_DAYS * 86400
+        if not ledger:
+            window_start = max(window_start, state["last_checked_time"])
+        query = f"is:unread after:{int(window_start)}"
+        print(f"Draining backlog ({order} first, {chunk_size} threads per chunk): {query}")
+
+    started = time.time()
+    processed = checkpoint['processed'] if checkpoint else 0
+    seen = set() # Across pages a thread can show up again (new mail moves it to the top)
+    async for threads, cursor in iter_chunks(client, query, order, chunk_size, checkpoint, checkpoint_file):
+        threads = [t for t in threads if t['id'] not in seen]
+        seen.update(t['id'] for t in threads)
+        if threads:
+            chunk_state = {**state, "pending_threads": threads, "last_checked_time": window_start}
+            new_state = await run_cycle(graph, client, chunk_state, ledger)
+            state["retry_queue"] = new_state.get("retry_queue", state["retry_queue"])
+            processed += len(threads)
+        _save_json(checkpoint_file, {
+            'order': order, 'query': query, 'window_start': window_start, 'cursor': cursor, 'processed': processed
+        })
+        print(f"Drain progress: {processed} thread(s), {processed / max(time.time() - started, 1e-6):.1f} threads/s")
+
+    _clear_checkpoint(checkpoint_file)
+    print(f"Backlog drained: {processed} thread(s) in {time.time() - started:.1f}s. Back to normal mode.")
+    if not ledger:
+        # Same as a normal cycle without a ledger: everything up to now is handled
+        state["last_checked_time"] = time.time()
+    return state
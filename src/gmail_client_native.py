@@ -1,20 +1,90 @@
 import os
 import os.path
 import base64
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+import google_auth_httplib2
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from email.message import EmailMessage
+from typing import Any, Dict, List
+from src.clients import build_gmail_service
+from src.credentials import get_credentials
+from src.mail_body import extract_body
+from src import metrics
+from src.rate_limiter import (
+    call_with_retry, backoff_delay, is_retryable_error, error_status, retry_after_seconds,
+    gmail_request_units, new_gmail_bucket
+)
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 TOKEN_FILE = 'token_python.json' # Use distinct token file to avoid format conflicts with node
 
+# How many Gmail API requests may be in flight at once (per client).
+GMAIL_MAX_CONCURRENCY = int(os.getenv("GMAIL_MAX_CONCURRENCY", "8"))
+# Gmail accepts up to 100 calls per batch, but recommends <= 50 to avoid rate limiting.
+GMAIL_BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100)
+GMAIL_BATCH_RETRIES = int(os.getenv("GMAIL_BATCH_RETRIES", "3"))
+# Where the last synced Gmail historyId is persisted between runs (history sync mode)
+SYNC_STATE_FILE = os.getenv("GMAIL_SYNC_STATE_FILE", "sync_state.json")
+# How much of each thread is downloaded when fetching new mail:
+# "metadata": every message of the thread, but only ids, dates, snippets and the headers below (default)
+# "latest": only the newest message of each thread (messages.get), same fields
+# "full": complete threads with all bodies and parts (old behaviour)
+GMAIL_FETCH_PROFILE = os.getenv("GMAIL_FETCH_PROFILE", "metadata")
+# Headers the agent actually reads: sender/subject, reply threading and the prefilter's bulk-mail checks
+METADATA_HEADERS = [
+    'From', 'Subject', 'Message-ID', 'List-Unsubscribe', 'List-Id', 'Precedence', 'Auto-Submitted'
+]
+# Partial-response masks: Gmail leaves everything else out of the JSON
+MESSAGE_METADATA_FIELDS = "id,threadId,internalDate,snippet,payload/headers"
+MESSAGE_BODY_FIELDS = "id,threadId,payload" # Attachments only carry an attachmentId, never their data
+# Replies sent in parallel by send_replies_bulk (each messages.send costs 100 quota units)
+GMAIL_SEND_CONCURRENCY = int(os.getenv("GMAIL_SEND_CONCURRENCY", "4"))
+# After replying: mark the customer's email as read and label it (empty label name: no label)
+MARK_REPLIED_AS_READ = os.getenv("MARK_REPLIED_AS_READ", "true").lower() == "true"
+AUTO_REPLY_LABEL = os.getenv("AUTO_REPLY_LABEL", "auto-replied")
+BATCH_MODIFY_LIMIT = 1000 # Max ids per users.messages.batchModify call
+
+# Raw HTTP connections per worker thread, shared by every client in the process
+# (each client only adds its own credentials on top), so many mailboxes reuse the
+# same keep-alive connections to gmail.googleapis.com.
+_thread_connections = threading.local()
+
+def _thread_connection():
+    http = getattr(_thread_connections, 'http', None)
+    if http is None:
+        http = httplib2.Http()
+        _thread_connections.http = http
+    return http
+
+def _send_is_retryable(error):
+    # messages.send is not idempotent: only retry when Gmail surely did not accept it
+    return error_status(error) in (429, 503)
+
 class GmailNativeClient:
-    def __init__(self):
+    def __init__(self, max_concurrency=None, sync_state_file=None, token_file=None, executor=None, fetch_profile=None):
         self.creds = None
         self.service = None
+        self.token_file = token_file # None: token_debug.json / token.json lookup
+        self.sync_state_file = sync_state_file or SYNC_STATE_FILE
+        self.max_concurrency = max_concurrency or GMAIL_MAX_CONCURRENCY
+        self.fetch_profile = fetch_profile or GMAIL_FETCH_PROFILE
+        if self.fetch_profile not in ("metadata", "latest", "full"):
+            raise ValueError(f"Unknown Gmail fetch profile: {self.fetch_profile}")
+        # googleapiclient is synchronous, so requests run on a bounded worker pool
+        # instead of blocking the event loop. Several clients may share one pool.
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="gmail-api")
+        self._semaphore = None # Created lazily, must belong to the running loop
+        self._local = threading.local()
+        self._quota = new_gmail_bucket() # Gmail per-user quota units/second
+        self._session = None
+        self._label_ids = {} # label name -> id
 
     async def connect(self):
         # 1. Load Credentials
@@ -30,35 +100,60 @@ class GmailNativeClient:
         # Node format has `access_token` etc flattened. Python uses `token`.
         
         target_token = 'token_debug.json'
-        if not os.path.exists(target_token):
+        if self.token_file:
+            target_token = self.token_file
+        elif not os.path.exists(target_token):
              # Try token.json, check format?
              target_token = 'token.json'
 
-        if os.path.exists(target_token):
-            try:
-                self.creds = Credentials.from_authorized_user_file(target_token, SCOPES)
-            except ValueError:
-                print(f"Token file {target_token} format mismatch. Re-run auth_manual.py or debug_auth.py")
-                # Fallback to re-auth?
-                pass
+        # Shared by every client using this token file, refreshed ahead of expiry in the background
+        self.creds = await get_credentials(target_token, SCOPES)
+        if not self.creds:
+             raise RuntimeError("No valid credentials found. Please run 'python src/debug_auth.py --run' first.")
 
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except Exception as e:
-                    print(f"Warning: Token refresh failed (Network issue?): {e}")
-                    # Do NOT clear creds here. If it's a network error, we want to try again later.
-                    # self.creds = None 
-                    pass
-            
-            if not self.creds:
-                 raise RuntimeError("No valid credentials found. Please run 'python src/debug_auth.py --run' first.")
-
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        self.service = build_gmail_service(self.creds)
         print("Gmail API Service built successfully.")
 
+    # --- Async Execution Layer ---
+
+    def _thread_http(self):
+        # httplib2.Http is not thread-safe, so every worker thread keeps its own
+        # authorized connection (reused across requests on that thread).
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=_thread_connection())
+            self._local.http = http
+        return http
+
+    async def _execute(self, request, max_attempts=None, retryable=is_retryable_error):
+        """Executes a googleapiclient request on the worker pool without blocking the loop.
+
+        Every attempt first takes its quota units from the per-user token bucket;
+        429/5xx/network errors are retried with backoff (honouring Retry-After).
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        units = gmail_request_units(request)
+        name = getattr(request, 'methodId', None) or "gmail batch"
+
+        async def attempt():
+            await self._quota.acquire(units)
+            async with self._semaphore:
+                with metrics.span("gmail_call", metrics.GMAIL_CALL_SECONDS, method=name):
+                    return await loop.run_in_executor(
+                        self._executor, lambda: request.execute(http=self._thread_http())
+                    )
+
+        kwargs = {} if max_attempts is None else {"max_attempts": max_attempts}
+        return await call_with_retry(
+            attempt, name=name,
+            buckets=(self._quota,), retryable=retryable, **kwargs
+        )
+
     # --- Tool Equivalents ---
+    # These return plain Python data. `session.call_tool` wraps them in MCP-style
+    # JSON results for callers that still expect the MCP interface.
     
     async def list_messages(self, query="is:unread", max_results=10):
         # We mimic the MCP tool interface? 
@@ -77,16 +172,257 @@ class GmailNativeClient:
         def __init__(self, text):
             self.content = [type('obj', (object,), {'text': text, 'type': 'text'})]
 
-    async def search_threads(self, query, max_results=10):
-        results = self.service.users().threads().list(userId='me', q=query, maxResults=max_results).execute()
-        threads = results.get('threads', [])
-        import json
-        return self.MockResult(json.dumps(threads))
+    async def search_threads(self, query, max_results=10) -> List[Dict[str, Any]]:
+        results = await self._execute(self.service.users().threads().list(userId='me', q=query, maxResults=max_results))
+        return results.get('threads', [])
+
+    async def search_latest_messages(self, query, max_results=10) -> List[Dict[str, Any]]:
+        """Like search_threads, but also returns the newest matching message id of each thread."""
+        results = await self._execute(self.service.users().messages().list(
+            userId='me', q=query, maxResults=max_results, fields="messages(id,threadId)"
+        ))
+        return self._latest_per_thread(results.get('messages', []))
+
+    @staticmethod
+    def _latest_per_thread(messages):
+        threads = {}
+        for message in messages: # Newest first
+            threads.setdefault(message['threadId'], {'id': message['threadId'], 'latestMessageId': message['id']})
+        return list(threads.values())
+
+    async def search(self, query, max_results=10) -> List[Dict[str, Any]]:
+        """Matching threads, in the shape get_latest_messages expects for the fetch profile."""
+        if self.fetch_profile == "latest":
+            return await self.search_latest_messages(query, max_results)
+        return await self.search_threads(query, max_results)
+
+    async def iter_search_pages(self, query, page_size=100, page_token=None):
+        """Async generator over ALL matching threads, one page at a time (newest first).
+
+        Yields (threads, next_page_token); the token lets a caller resume after a restart.
+        Only ids are listed, so paging through a huge backlog stays cheap.
+        """
+        while True:
+            if self.fetch_profile == "latest":
+                response = await self._execute(self.service.users().messages().list(
+                    userId='me', q=query, maxResults=page_size, pageToken=page_token,
+                    fields="messages(id,threadId),nextPageToken"
+                ))
+                threads = self._latest_per_thread(response.get('messages', []))
+            else:
+                response = await self._execute(self.service.users().threads().list(
+                    userId='me', q=query, maxResults=page_size, pageToken=page_token,
+                    fields="threads(id),nextPageToken"
+                ))
+                threads = response.get('threads', [])
+            page_token = response.get('nextPageToken')
+            yield threads, page_token
+            if not page_token:
+                break
+
+    def _thread_request(self, thread_id, profile):
+        if profile == "full":
+            return self.service.users().threads().get(userId='me', id=thread_id)
+        return self.service.users().threads().get(
+            userId='me', id=thread_id, format='metadata', metadataHeaders=METADATA_HEADERS,
+            fields=f"id,messages({MESSAGE_METADATA_FIELDS})"
+        )
+
+    def _message_request(self, message_id, profile):
+        if profile == "full":
+            return self.service.users().messages().get(
+                userId='me', id=message_id, format='full', fields=MESSAGE_BODY_FIELDS
+            )
+        return self.service.users().messages().get(
+            userId='me', id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS,
+            fields=MESSAGE_METADATA_FIELDS
+        )
+
+    async def get_thread(self, thread_id, profile="full") -> Dict[str, Any]:
+        return await self._execute(self._thread_request(thread_id, profile))
+
+    async def get_message(self, message_id, profile="full") -> Dict[str, Any]:
+        return await self._execute(self._message_request(message_id, profile))
+
+    async def _execute_batch(self, ids, make_request):
+        """Sends one multipart batch of get calls. Returns (results, errors) keyed by id."""
+        results, errors = {}, {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                results[request_id] = response
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for item_id in ids:
+            batch.add(make_request(item_id), request_id=item_id)
+
+        try:
+            # No whole-batch retry here: _get_batch retries the failed items itself
+            await self._execute(batch, max_attempts=1)
+        except Exception as e:
+            # The whole batch failed (network, auth...): every unanswered item gets the error
+            for item_id in ids:
+                if item_id not in results:
+                    errors[item_id] = e
+        return results, errors
+
+    async def _get_batch(self, ids, make_request, kind, max_retries):
+        """Fetches many items in as few HTTP round trips as possible.
+
+        Ids are chunked to the batch limit, chunks are sent concurrently and only the
+        items that failed with a retryable error are retried (with backoff).
+        """
+        ids = list(dict.fromkeys(ids)) # Dedupe, keep order
+        results = {}
+        pending = ids
+        attempt = 0
 
-    async def get_thread(self, thread_id):
-        tdata = self.service.users().threads().get(userId='me', id=thread_id).execute()
-        import json
-        return self.MockResult(json.dumps(tdata))
+        while pending:
+            chunks = [pending[i:i + GMAIL_BATCH_SIZE] for i in range(0, len(pending), GMAIL_BATCH_SIZE)]
+            outcomes = await asyncio.gather(*(self._execute_batch(chunk, make_request) for chunk in chunks))
+
+            retry = []
+            for chunk_results, chunk_errors in outcomes:
+                results.update(chunk_results)
+                for item_id, error in chunk_errors.items():
+                    if attempt < max_retries and is_retryable_error(error):
+                        retry.append(item_id)
+                    else:
+                        print(f"Error fetching {kind} {item_id} in batch: {error}")
+
+            pending = retry
+            if pending:
+                attempt += 1
+                retry_after = max(
+                    (retry_after_seconds(e) or 0 for _, chunk_errors in outcomes for e in chunk_errors.values()), default=0
+                )
+                delay = backoff_delay(attempt, retry_after or None)
+                print(f"Retrying {len(pending)} {kind}(s) from batch in {delay:.1f}s (attempt {attempt}/{max_retries})")
+                metrics.RETRIES.inc(len(pending), call=f"gmail batch {kind}")
+                await asyncio.sleep(delay)
+
+        return [results[item_id] for item_id in ids if item_id in results]
+
+    async def get_threads_batch(self, thread_ids, max_retries=GMAIL_BATCH_RETRIES, profile=None) -> List[Dict[str, Any]]:
+        """Fetches many threads with batched requests. `profile` defaults to the client's fetch profile."""
+        profile = "full" if (profile or self.fetch_profile) == "full" else "metadata"
+        return await self._get_batch(
+            thread_ids, lambda t_id: self._thread_request(t_id, profile), "thread", max_retries
+        )
+
+    async def get_messages_batch(self, message_ids, max_retries=GMAIL_BATCH_RETRIES, profile="metadata") -> List[Dict[str, Any]]:
+        """Fetches many single messages with batched requests ("metadata" or "full" with bodies)."""
+        return await self._get_batch(
+            message_ids, lambda m_id: self._message_request(m_id, profile), "message", max_retries
+        )
+
+    async def get_message_bodies(self, message_ids) -> Dict[str, str]:
+        """Readable body text per message id (see src/mail_body.py), downloaded in batches."""
+        messages = await self.get_messages_batch(message_ids, profile="full")
+        return {m['id']: extract_body(m.get('payload', {})) for m in messages}
+
+    async def get_latest_messages(self, threads) -> List[Dict[str, Any]]:
+        """The newest message of every thread in `threads`, fetched with the client's fetch profile.
+
+        With the "latest" profile, threads that already carry a `latestMessageId` (from
+        search_latest_messages or sync_history) cost one small messages.get each.
+        """
+        latest = []
+        if self.fetch_profile == "latest":
+            known = [t['latestMessageId'] for t in threads if t.get('latestMessageId')]
+            latest = await self.get_messages_batch(known)
+            threads = [t for t in threads if not t.get('latestMessageId')]
+        if threads:
+            for thread in await self.get_threads_batch([t['id'] for t in threads]):
+                if thread.get('messages'):
+                    latest.append(thread['messages'][-1])
+        return latest
+
+    # --- Incremental Sync (users.history.list) ---
+
+    def _load_sync_state(self):
+        if not os.path.exists(self.sync_state_file):
+            return {}
+        try:
+            with open(self.sync_state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read sync state {self.sync_state_file}: {e}")
+            return {}
+
+    def _save_sync_state(self, sync_state):
+        # Write to a temp file first so a crash never leaves a half-written state file
+        tmp_file = self.sync_state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(sync_state, f)
+        os.replace(tmp_file, self.sync_state_file)
+
+    def commit_sync_point(self, history_id):
+        """Saves the historyId sync_history returned, once its threads have been handled."""
+        self._save_sync_state({'historyId': history_id})
+
+    async def _full_resync(self, query):
+        # Take the historyId BEFORE searching so nothing arriving in between is missed
+        profile = await self._execute(self.service.users().getProfile(userId='me'))
+        # Every match, not just one page: the new sync point is past all of them
+        threads = []
+        async for page, _ in self.iter_search_pages(query, 500):
+            threads.extend(page)
+        print(f"Full resync done: {len(threads)} thread(s). Sync point: historyId {profile['historyId']}")
+        return threads, profile['historyId']
+
+    async def sync_history(self, query="is:unread"):
+        """Returns (threads, history_id): only threads that received new inbox messages since the last sync.
+
+        The first run (or an expired historyId) falls back to listing ALL threads matching
+        `query` (keep it bounded, e.g. with after:).
+        Nothing is saved here: call commit_sync_point(history_id) once the threads are
+        processed, so a failed or crashed cycle sees the same messages again.
+        """
+        start_history_id = self._load_sync_state().get('historyId')
+        if start_history_id is None:
+            return await self._full_resync(query)
+
+        latest_ids = {} # thread id -> newest added message id
+        latest_history_id = start_history_id
+        page_token = None
+        try:
+            while True:
+                response = await self._execute(self.service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    labelId='INBOX',
+                    pageToken=page_token
+                ))
+                for record in response.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        # History records come oldest first, so later ones win
+                        latest_ids[added['message']['threadId']] = added['message']['id']
+                latest_history_id = response.get('historyId', latest_history_id)
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+        except HttpError as e:
+            # 404 means the historyId is too old (Gmail keeps roughly a week of history)
+            if e.resp.status == 404:
+                print(f"History id {start_history_id} expired. Falling back to full resync.")
+                return await self._full_resync(query)
+            raise
+
+        return [{'id': t_id, 'latestMessageId': m_id} for t_id, m_id in latest_ids.items()], latest_history_id
+
+    async def watch(self, topic_name, label_ids=('INBOX',)):
+        """Asks Gmail to publish mailbox changes to a Pub/Sub topic (expires after ~7 days)."""
+        response = await self._execute(self.service.users().watch(userId='me', body={
+            'topicName': topic_name,
+            'labelIds': list(label_ids),
+            'labelFilterBehavior': 'INCLUDE'
+        }))
+        print(f"Gmail watch active on {topic_name} until {response.get('expiration')}")
+        return response
 
     async def send_reply(self, to, subject, body, thread_id):
         # Send message
@@ -102,10 +438,72 @@ class GmailNativeClient:
             'threadId': thread_id
         }
         
-        sent = self.service.users().messages().send(userId="me", body=create_message).execute()
+        sent = await self._execute(
+            self.service.users().messages().send(userId="me", body=create_message), retryable=_send_is_retryable
+        )
         print(f"Message sent: {sent['id']}")
         return sent
 
+    async def send_replies_bulk(self, replies, concurrency=None):
+        """Sends many replies concurrently (at most `concurrency` at once).
+
+        `replies` are dicts with to, subject, body and threadId. Returns (sent, failures):
+        the replies that went out, and (reply, exception) pairs for the ones that did not.
+        """
+        limit = asyncio.Semaphore(concurrency or GMAIL_SEND_CONCURRENCY)
+        sent, failures = [], []
+
+        async def send_one(reply):
+            async with limit:
+                try:
+                    await self.send_reply(reply['to'], reply['subject'], reply['body'], reply['threadId'])
+                    sent.append(reply)
+                except Exception as e:
+                    failures.append((reply, e))
+
+        await asyncio.gather(*(send_one(reply) for reply in replies))
+        return sent, failures
+
+    async def _load_labels(self):
+        labels = await self._execute(self.service.users().labels().list(userId='me', fields="labels(id,name)"))
+        for label in labels.get('labels', []):
+            self._label_ids[label['name']] = label['id']
+
+    async def get_label_id(self, name):
+        """Id of the user label `name`, created on first use."""
+        if name not in self._label_ids:
+            await self._load_labels()
+        if name not in self._label_ids:
+            try:
+                label = await self._execute(self.service.users().labels().create(userId='me', body={
+                    'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'
+                }))
+                self._label_ids[name] = label['id']
+            except HttpError as e:
+                if e.resp.status != 409:
+                    raise
+                await self._load_labels() # 409: another process created it meanwhile
+        return self._label_ids[name]
+
+    async def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """Changes labels of many messages with users.messages.batchModify (1000 ids per call)."""
+        message_ids = list(dict.fromkeys(message_ids))
+        for i in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+            await self._execute(self.service.users().messages().batchModify(userId='me', body={
+                'ids': message_ids[i:i + BATCH_MODIFY_LIMIT],
+                'addLabelIds': list(add_label_ids),
+                'removeLabelIds': list(remove_label_ids)
+            }))
+
+    async def mark_replied(self, message_ids):
+        """Marks answered emails as read and adds the AUTO_REPLY_LABEL, so `is:unread` stops returning them."""
+        if not message_ids:
+            return
+        add = [await self.get_label_id(AUTO_REPLY_LABEL)] if AUTO_REPLY_LABEL else []
+        remove = ['UNREAD'] if MARK_REPLIED_AS_READ else []
+        if add or remove:
+            await self.batch_modify(message_ids, add, remove)
+
     # Helper to act as MCP session for agent_graph
     # agent_graph calls `mcp_client.session.call_tool("name", args)`
     # We can inject a dummy session.
@@ -116,21 +514,34 @@ class GmailNativeClient:
         
         async def call_tool(self, name, arguments):
             if name == "search_threads":
-                return await self.client.search_threads(arguments.get('query'), arguments.get('maxResults'))
+                result = await self.client.search_threads(arguments.get('query'), arguments.get('maxResults'))
             elif name == "get_thread":
-                return await self.client.get_thread(arguments.get('threadId'))
-            elif name == "send_message":
+                result = await self.client.get_thread(arguments.get('threadId'), arguments.get('profile', 'full'))
+            elif name == "sync_history":
+                result, history_id = await self.client.sync_history(arguments.get('query', 'is:unread'))
+                self.client.commit_sync_point(history_id) # Tool callers have no later point to commit at
+            elif name == "get_threads_batch":
+                result = await self.client.get_threads_batch(arguments.get('threadIds', []))
+            else:
+                result = None
+            if name == "send_message":
                 # agent_graph in send_replies calls 'send_reply' on client wrapper, 
                 # but inside wrapper it calls 'send_message'.
                 # Wait, agent_graph calls `mcp_client.send_reply`.
                 # So we just need `send_reply` on the main client class.
                 pass
-            return None
+            if result is None:
+                return None
+            return self.client.MockResult(json.dumps(result))
 
     @property
     def session(self):
-        return self.FakeSession(self)
+        # One session per client (it is stateless, no need to rebuild it on every access)
+        if self._session is None:
+            self._session = self.FakeSession(self)
+        return self._session
         
     async def close(self):
-        pass
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
 
@@ -0,0 +1,114 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Durable record of every message the agent has touched and how far it got.
+# Replaces "last_checked_time" as the source of truth for de-duplication:
+# a message is processed again only if it never reached a final status.
+
+LEDGER_ENABLED = os.getenv("LEDGER_ENABLED", "true").lower() == "true"
+LEDGER_FILE = os.getenv("LEDGER_FILE", "ledger.sqlite3")
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "30"))
+
+# fetched -> filtered -> replied -> sent   (happy path)
+# fetched -> skipped                      (rejected by prefilter / filter)
+# failed: Gmail rejected the send (429/503), waiting in the retry queue
+# send_error: sending failed for good, or Gmail may have accepted it anyway (5xx, timeout);
+#             never sent again, a double reply is worse than a missing one
+STATUSES = ("fetched", "filtered", "skipped", "replied", "sent", "failed", "send_error")
+DONE_STATUSES = ("skipped", "sent", "send_error")
+
+class MessageLedger:
+    def __init__(self, path=LEDGER_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL: readers never block the writer, and a crash never corrupts the file
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                message_id TEXT PRIMARY KEY,
+                thread_id TEXT,
+                status TEXT NOT NULL,
+                internal_date REAL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_updated_at ON processed_messages(updated_at)")
+        self._conn.commit()
+        # Done ids are kept in memory too, so the per-message check in fetch is a set lookup
+        self._done = {row[0] for row in self._conn.execute(
+            f"SELECT message_id FROM processed_messages WHERE status IN ({','.join('?' * len(DONE_STATUSES))})",
+            DONE_STATUSES
+        )}
+
+    def is_done(self, message_id):
+        return message_id in self._done
+
+    def status(self, message_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM processed_messages WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark(self, messages, status):
+        """Records `status` for a list of message dicts (need 'id', optionally 'threadId'/'internalDate')."""
+        if status not in STATUSES:
+            raise ValueError(f"Unknown ledger status: {status}")
+        if not messages:
+            return
+        now = time.time()
+        rows = [(msg['id'], msg.get('threadId'), status, msg.get('internalDate'), now) for msg in messages]
+        with self._lock:
+            self._conn.executemany("""
+                INSERT INTO processed_messages (message_id, thread_id, status, internal_date, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET
+                    status = excluded.status,
+                    thread_id = COALESCE(excluded.thread_id, thread_id),
+                    internal_date = COALESCE(excluded.internal_date, internal_date),
+                    updated_at = excluded.updated_at
+            """, rows)
+            self._conn.commit()
+        if status in DONE_STATUSES:
+            self._done.update(row[0] for row in rows)
+        else:
+            self._done.difference_update(row[0] for row in rows)
+
+    def watermark(self):
+        """Newest message time (seconds) the ledger has seen, or None if empty."""
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(internal_date) FROM processed_messages").fetchone()
+        return row[0]
+
+    def compact(self, retention_days=LEDGER_RETENTION_DAYS):
+        """Deletes finished entries older than the retention window. Returns how many were removed."""
+        cutoff = time.time() - retention_days * 86400
+        with self._lock:
+            removed = [row[0] for row in self._conn.execute(
+                f"SELECT message_id FROM processed_messages WHERE updated_at < ? AND status IN ({','.join('?' * len(DONE_STATUSES))})",
+                (cutoff, *DONE_STATUSES)
+            )]
+            self._conn.executemany("DELETE FROM processed_messages WHERE message_id = ?", [(m,) for m in removed])
+            self._conn.commit()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._done.difference_update(removed)
+        return len(removed)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_ledger = None
+
+def get_ledger():
+    """Process-wide ledger, or None when disabled."""
+    global _ledger
+    if not LEDGER_ENABLED:
+        return None
+    if _ledger is None:
+        _ledger = MessageLedger()
+    return _ledger
@@ -0,0 +1,158 @@
+import os
+import re
+import base64
+import codecs
+from html.parser import HTMLParser
+
+# Turns a Gmail message payload (format=full) into the text the reply is written from.
+# - text/plain is preferred, HTML is converted to text only when there is no plain part
+# - base64url data is decoded in small chunks and decoding stops once the budget is full,
+#   so a huge email never gets decoded (or held as text) in one piece
+# - attachments are never decoded
+# - quoted history ("On ... wrote:", "> ...") and signatures are cut off
+
+BODY_MAX_TOKENS = int(os.getenv("BODY_MAX_TOKENS", "1000")) # ~4 characters per token
+DECODE_CHUNK = 16384 # base64 characters per decode step (multiple of 4)
+
+# A line matching one of these ends the new part of the email (everything below is history/signature)
+CUTOFF_PATTERNS = [
+    re.compile(r"^--\s?$"), # Standard signature delimiter "-- "
+    re.compile(r"^on\b.{0,200}\bwrote:$", re.IGNORECASE), # Gmail / Apple Mail reply header
+    re.compile(r"^-{2,}\s*(original message|forwarded message)\s*-{2,}$", re.IGNORECASE),
+    re.compile(r"^_{10,}$"), # Outlook separator line
+    re.compile(r"^(sent from my|get outlook for)\b", re.IGNORECASE),
+]
+
+BLOCK_TAGS = {"br", "p", "div", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol"}
+SKIP_TAGS = {"script", "style", "head", "title", "blockquote"}
+
+def _header(part, name):
+    for header in part.get("headers", []):
+        if header["name"].lower() == name.lower():
+            return header["value"]
+    return ""
+
+def _charset(part):
+    match = re.search(r'charset="?([^";\s]+)', _header(part, "Content-Type"), re.IGNORECASE)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+def _is_attachment(part):
+    body = part.get("body", {})
+    return bool(part.get("filename")) or "attachmentId" in body \
+        or _header(part, "Content-Disposition").lower().startswith("attachment")
+
+def _leaf_parts(payload):
+    """Every non-multipart part, depth first (so the main body comes before forwarded ones)."""
+    if payload.get("parts"):
+        for part in payload["parts"]:
+            yield from _leaf_parts(part)
+    else:
+        yield payload
+
+def _find_part(payload, mime_type):
+    for part in _leaf_parts(payload):
+        if part.get("mimeType") == mime_type and not _is_attachment(part) and part.get("body", {}).get("data"):
+            return part
+    return None
+
+def _decoded_chunks(part):
+    """Decodes a part's base64url data piece by piece."""
+    data = part["body"]["data"]
+    decoder = codecs.getincrementaldecoder(_charset(part))(errors="replace")
+    for start in range(0, len(data), DECODE_CHUNK):
+        piece = data[start:start + DECODE_CHUNK]
+        yield decoder.decode(base64.urlsafe_b64decode(piece + "=" * (-len(piece) % 4)))
+    yield decoder.decode(b"", final=True)
+
+def _lines(chunks):
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        yield from lines
+        if len(pending) > DECODE_CHUNK:
+            # Text without line breaks: hand it on in pieces instead of buffering all of it
+            yield pending
+            pending = ""
+    if pending:
+        yield pending
+
+def _clean(lines, max_chars):
+    """Drops quoted lines, stops at history/signature markers and at `max_chars`."""
+    kept, size = [], 0
+    for line in lines:
+        line = " ".join(line.split()) # Collapse whitespace (also removes \r)
+        if line.startswith(">"):
+            continue
+        if any(pattern.match(line) for pattern in CUTOFF_PATTERNS):
+            break
+        if not line and (not kept or not kept[-1]):
+            continue # No leading or repeated blank lines
+        kept.append(line)
+        size += len(line) + 1
+        if size >= max_chars:
+            break
+    return "\n".join(kept).strip()[:max_chars]
+
+class _HTMLText(HTMLParser):
+    """Collects the visible text of an HTML body, without quoted history blocks."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.size = 0
+        self._skip_tag = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        classes = dict(attrs).get("class") or ""
+        if tag in SKIP_TAGS or (tag == "div" and "gmail_quote" in classes):
+            self._skip_tag, self._skip_depth = tag, 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_tag = None
+            return
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_tag:
+            self.parts.append(data)
+            self.size += len(data)
+
+def _html_chunks(chunks, max_chars):
+    parser = _HTMLText()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.size >= max_chars * 2: # Room for whitespace that gets collapsed later
+            break
+    parser.close()
+    yield "".join(parser.parts)
+
+def extract_body(payload, max_tokens=BODY_MAX_TOKENS):
+    """The new text of an email (no quotes, no signature), at most ~`max_tokens` tokens. "" if none."""
+    max_chars = max_tokens * 4
+    plain = _find_part(payload, "text/plain")
+    if plain:
+        text = _clean(_lines(_decoded_chunks(plain)), max_chars)
+        if text:
+            return text
+    html = _find_part(payload, "text/html")
+    if html:
+        return _clean(_lines(_html_chunks(_decoded_chunks(html), max_chars)), max_chars)
+    return ""
@@ -4,54 +4,137 @@ import os
 from dotenv import load_dotenv
 from src.gmail_client_native import GmailNativeClient
 from src.agent_graph import create_graph
+from src.push_receiver import PushReceiver
+from src.ledger import get_ledger
+from src.pipeline import run_streaming_cycle
+from src.clients import close_clients
+from src.drain import drain_backlog, DRAIN_MODE
+from src import metrics
 
 # Load env variables from .env
 load_dotenv()
 
+# "poll": run a cycle every POLL_INTERVAL seconds (default)
+# "push": run a cycle as soon as a Gmail push notification arrives, with a slow fallback poll
+TRIGGER_MODE = os.getenv("AGENT_TRIGGER_MODE", "poll")
+# "graph": run the LangGraph nodes as whole-batch steps (default)
+# "stream": every message flows through the stages on its own (see src/pipeline.py)
+EXECUTION_MODE = os.getenv("AGENT_EXECUTION_MODE", "graph")
+POLL_INTERVAL = int(os.getenv("AGENT_POLL_SECONDS", "60"))
+FALLBACK_POLL_INTERVAL = int(os.getenv("AGENT_FALLBACK_POLL_SECONDS", "900"))
+PUSH_HOST = os.getenv("PUSH_HOST", "0.0.0.0")
+PUSH_PORT = int(os.getenv("PUSH_PORT", "8085"))
+PUSH_PATH = os.getenv("PUSH_PATH", "/gmail/push")
+PUSH_DEBOUNCE_SECONDS = float(os.getenv("PUSH_DEBOUNCE_SECONDS", "2"))
+PUSH_VERIFICATION_TOKEN = os.getenv("PUSH_VERIFICATION_TOKEN")
+# e.g. projects/my-project/topics/gmail-push. If unset, notifications must come from elsewhere.
+GMAIL_PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+WATCH_RENEW_MARGIN = 86400 # Re-register the Gmail watch a day before it expires
+FIRST_RUN_LOOKBACK = 86400 # Empty ledger: look back 24 hours to catch recent test emails
+LEDGER_RESTART_SLACK = 3600 # Otherwise: re-scan from just before the newest known message
+
+async def run_cycle(graph, client, state, ledger=None, index=None):
+    """Runs one agent cycle in the configured execution mode and returns the new state."""
+    with metrics.span("cycle", metrics.CYCLE_SECONDS, mode=EXECUTION_MODE):
+        if EXECUTION_MODE == "stream":
+            return await run_streaming_cycle(client, state, ledger, index)
+        return await graph.ainvoke(state)
+
 async def main():
     print("Starting Auto Mail Agent (Native Mode)...")
     print(f"Time: {time.ctime()}")
 
     # Initialize Client
     client = GmailNativeClient()
-    
+    receiver = None
+    metrics_server = None
+    watch_expiration = 0
+
     try:
         await client.connect()
         print("MCP Client Connected.")
-        
+        metrics_server = await metrics.start_metrics_server()
+
         # Build Graph
-        graph = create_graph(client)
-        
+        ledger = get_ledger()
+        graph = create_graph(client, ledger)
+
         # Initialize State
-        # We start checking from NOW. Old emails are ignored.
+        # The ledger knows exactly which messages were handled, so after a restart we only
+        # need to resume from the newest message it has seen (anything older is done).
+        start_time = time.time() - FIRST_RUN_LOOKBACK
+        if ledger:
+            removed = ledger.compact()
+            if removed:
+                print(f"Ledger compacted: removed {removed} old entries.")
+            watermark = ledger.watermark()
+            if watermark:
+                start_time = watermark - LEDGER_RESTART_SLACK
         state = {
             "messages": [],
             "replies_to_send": [],
-            "last_checked_time": time.time() - 86400 # Look back 24 hours to catch recent test emails
+            "last_checked_time": start_time,
+            "retry_queue": [],
+            "pending_threads": [],
+            "backlog": False,
+            "send_failures": [],
+            "sync_point": None
         }
-        
+
+        if TRIGGER_MODE == "push":
+            receiver = PushReceiver(PUSH_HOST, PUSH_PORT, PUSH_PATH, PUSH_DEBOUNCE_SECONDS, PUSH_VERIFICATION_TOKEN)
+            await receiver.start()
+
         print(f"Agent Active. Filter Start Time: {state['last_checked_time']}")
+        if DRAIN_MODE in ("startup", "auto"):
+            state = await drain_backlog(run_cycle, graph, client, state, ledger)
         print("Waiting for new emails... (Ctrl+C to stop)")
-        
+
         while True:
+            # Keep the Gmail watch registered (it expires after ~7 days)
+            if receiver and GMAIL_PUBSUB_TOPIC and time.time() > watch_expiration - WATCH_RENEW_MARGIN:
+                try:
+                    watch = await client.watch(GMAIL_PUBSUB_TOPIC)
+                    watch_expiration = int(watch.get('expiration', 0)) / 1000.0
+                except Exception as e:
+                    print(f"Warning: Could not register Gmail watch: {e}")
+
             # Run the graph
             # invoke returns the final state
-            new_state = await graph.ainvoke(state)
-            
-            # Update state for next iteration (crucially, the timestamp)
+            new_state = await run_cycle(graph, client, state, ledger)
+
+            # Update state for next iteration (crucially, the timestamp and the failed items to retry)
             state["last_checked_time"] = new_state.get("last_checked_time", time.time())
-            
-            # Sleep
-            sleep_time = 60
-            print(f"Cycle Complete. Sleeping for {sleep_time}s...")
-            await asyncio.sleep(sleep_time)
-            
+            state["retry_queue"] = new_state.get("retry_queue", state["retry_queue"])
+            if state["retry_queue"]:
+                print(f"{len(state['retry_queue'])} item(s) waiting for retry.")
+            if DRAIN_MODE == "auto" and new_state.get("backlog"):
+                # A full page of unread mail: more is waiting, so work through it right away
+                print("Unread backlog detected.")
+                state = await drain_backlog(run_cycle, graph, client, state, ledger)
+                continue
+
+            if receiver:
+                print(f"Cycle Complete. Waiting for push notification (fallback poll in {FALLBACK_POLL_INTERVAL}s)...")
+                if not await receiver.wait_for_mail(FALLBACK_POLL_INTERVAL):
+                    print("No push notification received. Running fallback poll.")
+            else:
+                # Sleep
+                sleep_time = POLL_INTERVAL
+                print(f"Cycle Complete. Sleeping for {sleep_time}s...")
+                await asyncio.sleep(sleep_time)
+
     except KeyboardInterrupt:
         print("Stopping Agent...")
     except Exception as e:
         print(f"Critical Error: {e}")
     finally:
+        if receiver:
+            await receiver.stop()
+        if metrics_server:
+            await metrics_server.stop()
         await client.close()
+        await close_clients()
         print("Agent Stopped.")
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import threading
+import asyncio
+from contextlib import contextmanager
+
+# Instrumentation: timing spans, counters and histograms for the agent.
+# - Metrics are exposed in the Prometheus text format on http://<host>:<METRICS_PORT>/metrics
+# - Every finished span can also be appended to a JSON-lines trace file (METRICS_TRACE_FILE)
+# No client library needed: the registry below only implements what we use.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # 0: no HTTP endpoint
+METRICS_TRACE_FILE = os.getenv("METRICS_TRACE_FILE") # Unset: no trace file
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {} # sorted label pairs -> value
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED or not amount:
+            return
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.values = {} # sorted label pairs -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(sorted(labels.items()))
+        data = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, data in self.values.items():
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_label_text(key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_label_text(key, [('le', '+Inf')])} {data[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_label_text(key)} {data[-1]}")
+        return lines
+
+# --- The agent's metrics ---
+
+CYCLE_SECONDS = Histogram("mail_agent_cycle_seconds", "Duration of a whole agent cycle.")
+NODE_SECONDS = Histogram("mail_agent_node_seconds", "Duration of a graph node / pipeline stage run.")
+GMAIL_CALL_SECONDS = Histogram("mail_agent_gmail_call_seconds", "Duration of a Gmail API HTTP call (per attempt).")
+LLM_CALL_SECONDS = Histogram("mail_agent_llm_call_seconds", "Duration of an LLM call (per attempt).")
+MESSAGES = Counter("mail_agent_messages_total", "Emails that reached a processing status.")
+TOKENS = Counter("mail_agent_llm_tokens_total", "LLM tokens used, by node and kind (prompt/completion).")
+RETRIES = Counter("mail_agent_retries_total", "Retried calls (Gmail, Groq) and re-queued items.")
+ERRORS = Counter("mail_agent_errors_total", "Failed spans and failed items.")
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- Spans ---
+
+_trace_lock = threading.Lock()
+_trace_file = None
+
+def _write_trace(record):
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(METRICS_TRACE_FILE, "a", encoding="utf-8")
+        _trace_file.write(json.dumps(record) + "\n")
+        _trace_file.flush()
+
+@contextmanager
+def span(name, histogram=None, **labels):
+    """Times the block: observes `histogram` (with `labels`) and writes a trace line.
+
+    An exception inside the block counts as an error for `name` and is re-raised.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        duration = time.time() - started
+        if histogram is not None:
+            histogram.observe(duration, **labels)
+        if error is not None and not isinstance(error, asyncio.CancelledError):
+            ERRORS.inc(where=name)
+        if METRICS_TRACE_FILE:
+            record = {"span": name, "start": started, "duration": round(duration, 6), **labels}
+            if error is not None:
+                record["error"] = f"{error.__class__.__name__}: {error}"[:200]
+            _write_trace(record)
+
+# --- HTTP endpoint ---
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Metrics available on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # Headers are not needed
+            parts = request_line.split(' ')
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                body = render().encode()
+                head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                body = b''
+                head = "HTTP/1.1 404 Not Found\r\n"
+            writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            print(f"Metrics endpoint: error handling request: {e}")
+        finally:
+            writer.close()
+
+async def start_metrics_server(port_offset=0):
+    """Starts the endpoint if METRICS_PORT is set. Returns the server (or None)."""
+    if not METRICS_ENABLED or not METRICS_PORT:
+        return None
+    server = MetricsServer(METRICS_HOST, METRICS_PORT + port_offset)
+    await server.start()
+    return server
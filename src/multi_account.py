@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+from src.gmail_client_native import GmailNativeClient
+from src.agent_graph import create_graph
+from src.ledger import MessageLedger, LEDGER_ENABLED
+from src.clients import close_clients
+from src import metrics
+from src import reply_index
+from src import rate_limiter
+from src import prefilter
+from src.main import run_cycle, FIRST_RUN_LOOKBACK, LEDGER_RESTART_SLACK
+
+# Multi-mailbox runner: many Gmail accounts in one process.
+# All accounts share one Gmail worker pool (and its keep-alive connections) and one LLM
+# client. Each account gets its own token, ledger, sync state and reply index, and runs its
+# cycles at most every `min_interval` seconds. A global limit caps how many cycles run at once;
+# waiting accounts are served first come, first served, so no mailbox starves.
+#
+# Usage:  python -m src.multi_account [accounts.json]
+#
+# accounts.json:
+# [
+#   {"name": "store-1", "token_file": "tokens/store-1.json"},
+#   {"name": "store-2", "token_file": "tokens/store-2.json", "min_interval": 120, "max_concurrency": 4}
+# ]
+
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "accounts.json")
+MULTI_MAX_CONCURRENT_CYCLES = int(os.getenv("MULTI_MAX_CONCURRENT_CYCLES", "8"))
+MULTI_GMAIL_WORKERS = int(os.getenv("MULTI_GMAIL_WORKERS", "32")) # Shared Gmail thread pool size
+MULTI_PROCESSES = int(os.getenv("MULTI_PROCESSES", "1")) # >1: shard accounts over several processes
+DEFAULT_MIN_INTERVAL = int(os.getenv("AGENT_POLL_SECONDS", "60"))
+DEFAULT_ACCOUNT_CONCURRENCY = 4 # Gmail requests in flight per account
+
+def load_accounts(path=ACCOUNTS_FILE):
+    with open(path, 'r') as f:
+        accounts = json.load(f)
+    for account in accounts:
+        if 'name' not in account or 'token_file' not in account:
+            raise ValueError(f"Account entry needs 'name' and 'token_file': {account}")
+    return accounts
+
+class AccountWorker:
+    def __init__(self, account, executor):
+        self.name = account['name']
+        self.min_interval = account.get('min_interval', DEFAULT_MIN_INTERVAL)
+        self.client = GmailNativeClient(
+            max_concurrency=account.get('max_concurrency', DEFAULT_ACCOUNT_CONCURRENCY),
+            sync_state_file=account.get('sync_state_file', f"sync_state_{self.name}.json"),
+            token_file=account['token_file'],
+            executor=executor
+        )
+        self.ledger = None
+        if LEDGER_ENABLED:
+            self.ledger = MessageLedger(account.get('ledger_file', f"ledger_{self.name}.sqlite3"))
+        # Own reply index too: a reply to one store's customer must never go to another store's
+        self.index = reply_index.get_index(account.get('reply_index_file', f"reply_index_{self.name}"))
+        self.graph = None
+        self.state = None
+
+    async def connect(self):
+        await self.client.connect()
+        self.graph = create_graph(self.client, self.ledger, self.index)
+        start_time = time.time() - FIRST_RUN_LOOKBACK
+        if self.ledger:
+            self.ledger.compact()
+            watermark = self.ledger.watermark()
+            if watermark:
+                start_time = watermark - LEDGER_RESTART_SLACK
+        self.state = {"messages": [], "replies_to_send": [], "last_checked_time": start_time, "retry_queue": []}
+
+    async def run_forever(self, cycle_slots):
+        while True:
+            started = time.time()
+            async with cycle_slots:
+                print(f"[{self.name}] Cycle started")
+                try:
+                    new_state = await run_cycle(self.graph, self.client, self.state, self.ledger, self.index)
+                    self.state["last_checked_time"] = new_state.get("last_checked_time", self.state["last_checked_time"])
+                    self.state["retry_queue"] = new_state.get("retry_queue", self.state["retry_queue"])
+                except Exception as e:
+                    print(f"[{self.name}] Cycle failed: {e}")
+            # Per-account rate limit: cycles start at most every min_interval seconds
+            await asyncio.sleep(max(0, started + self.min_interval - time.time()))
+
+async def run_accounts(accounts, shard=0):
+    executor = ThreadPoolExecutor(max_workers=MULTI_GMAIL_WORKERS, thread_name_prefix="gmail-api")
+    # Every shard process serves its own metrics, on METRICS_PORT + shard number
+    metrics_server = await metrics.start_metrics_server(shard)
+    workers = [AccountWorker(account, executor) for account in accounts]
+
+    results = await asyncio.gather(*(worker.connect() for worker in workers), return_exceptions=True)
+    active = []
+    for worker, result in zip(workers, results):
+        if isinstance(result, Exception):
+            print(f"[{worker.name}] Could not connect, skipping this account: {result}")
+        else:
+            active.append(worker)
+    print(f"Running {len(active)}/{len(workers)} mailbox(es), max {MULTI_MAX_CONCURRENT_CYCLES} cycles at once.")
+
+    cycle_slots = asyncio.Semaphore(MULTI_MAX_CONCURRENT_CYCLES)
+    try:
+        await asyncio.gather(*(worker.run_forever(cycle_slots) for worker in active))
+    finally:
+        for worker in workers:
+            await worker.client.close()
+            if worker.ledger:
+                worker.ledger.close()
+        executor.shutdown(wait=False)
+        if metrics_server:
+            await metrics_server.stop()
+        await close_clients()
+
+def _run_shard(shard, accounts, shard_count=1):
+    load_dotenv()
+    # Groq limits are per API key: every process gets its share, or together they overshoot
+    rate_limiter._groq_limiter = rate_limiter.GroqLimiter(rate_limiter.GROQ_REQUESTS_PER_MINUTE / shard_count,
+                                                          rate_limiter.GROQ_TOKENS_PER_MINUTE / shard_count)
+    if shard_count > 1:
+        # Own keyword model file per process, so they don't overwrite each other's saves
+        base, ext = os.path.splitext(prefilter.PREFILTER_MODEL_FILE)
+        prefilter.get_model(f"{base}_shard{shard}{ext}")
+    asyncio.run(run_accounts(accounts, shard))
+
+def run_sharded(accounts, processes):
+    """Spreads accounts over `processes` OS processes (round robin) to use several cores."""
+    shards = [accounts[i::processes] for i in range(processes)]
+    shards = [shard for shard in shards if shard]
+    print(f"Sharding {len(accounts)} mailbox(es) over {len(shards)} process(es).")
+    with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        for result in pool.map(_run_shard, range(len(shards)), shards, [len(shards)] * len(shards)):
+            pass
+
+def main():
+    load_dotenv()
+    path = sys.argv[1] if len(sys.argv) > 1 else ACCOUNTS_FILE
+    accounts = load_accounts(path)
+    try:
+        if MULTI_PROCESSES > 1:
+            run_sharded(accounts, MULTI_PROCESSES)
+        else:
+            asyncio.run(run_accounts(accounts))
+    except KeyboardInterrupt:
+        print("Stopping Agent...")
+
+if __name__ == "__main__":
+    main()
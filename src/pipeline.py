@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+from src.agent_graph import (
+    fetch_emails, prefilter_emails, filter_emails, load_bodies, generate_replies, send_replies,
+    commit_sync_point
+)
+from src.rate_limiter import take_due
+from src import metrics
+from src import reply_index
+
+# Streaming execution mode.
+# The graph runs fetch -> filter -> bodies -> reply -> send as barriers over the whole batch, so the
+# first reply waits for every message to be classified and answered. Here every message
+# moves through the stages on its own, with bounded queues in between (backpressure) and
+# a separate worker count per stage. The stages reuse the graph node functions, called
+# with a single-message state, so caching / ledger / prefilter behave exactly the same.
+# The reply and send stages take small time-boxed batches instead (up to STREAM_BATCH_SIZE
+# items, waiting at most STREAM_BATCH_WAIT_SECONDS for more), so bodies are fetched and
+# answered threads marked with one Gmail batch per group instead of one per email.
+
+STREAM_FILTER_WORKERS = int(os.getenv("STREAM_FILTER_WORKERS", "5"))
+STREAM_REPLY_WORKERS = int(os.getenv("STREAM_REPLY_WORKERS", "5"))
+STREAM_SEND_WORKERS = int(os.getenv("STREAM_SEND_WORKERS", "4"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "10"))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "10")) # Max items per reply/send batch
+STREAM_BATCH_WAIT_SECONDS = float(os.getenv("STREAM_BATCH_WAIT_SECONDS", "0.5"))
+
+async def _take_batch(inbox, size, wait, closed):
+    """The next item of `inbox`, plus whatever else arrives within `wait` seconds (up to `size` items).
+
+    Stops waiting as soon as `closed` is set (nothing more will come).
+    """
+    items = [await inbox.get()]
+    deadline = time.monotonic() + wait
+    while len(items) < size:
+        if not inbox.empty():
+            items.append(inbox.get_nowait())
+            continue
+        timeout = deadline - time.monotonic()
+        if timeout <= 0 or closed.is_set():
+            break
+        getter = asyncio.ensure_future(inbox.get())
+        closer = asyncio.ensure_future(closed.wait())
+        await asyncio.wait({getter, closer}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        closer.cancel()
+        if not getter.done():
+            getter.cancel() # An item that was already handed over stays in the queue
+            break
+        items.append(getter.result())
+    return items
+
+def _start_stage(name, inbox, outbox, workers, handler, batch_size=1, closed=None):
+    """Starts `workers` tasks that take items from `inbox`, run `handler` and put results in `outbox`.
+
+    `handler` gets a list of up to `batch_size` items. Set the `closed` event once the
+    previous stage is done, so a partial batch is handled right away.
+    """
+    collecting = asyncio.Lock() # One worker fills its batch at a time, so batches don't split up
+    closed = closed or asyncio.Event()
+
+    async def worker():
+        while True:
+            async with collecting:
+                items = await _take_batch(inbox, batch_size, STREAM_BATCH_WAIT_SECONDS if batch_size > 1 else 0, closed)
+            try:
+                with metrics.span("node", metrics.NODE_SECONDS, node=name):
+                    results = await handler(items)
+                for result in results:
+                    if outbox is not None:
+                        await outbox.put(result) # Blocks while the next stage is full
+            except Exception as e:
+                print(f"Stream stage '{name}' failed for {len(items)} item(s): {e}")
+            finally:
+                for _ in items:
+                    inbox.task_done()
+
+    return [asyncio.create_task(worker()) for _ in range(workers)]
+
+async def _drain_stage(inbox, tasks):
+    """Waits until everything queued for a stage is handled, then stops its workers."""
+    await inbox.join()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run_pipeline(messages, mcp_client, ledger=None, retry_queue=None, index=None):
+    """Pushes messages (any async or sync iterable) through prefilter -> filter -> reply -> send.
+
+    Due reply/send entries of `retry_queue` are injected into their stage. The returned
+    stats hold the updated queue under "retry_queue". `index`: the reply index (default: the process one).
+    """
+    if index is None:
+        index = reply_index.get_index()
+    started = time.time()
+    stats = {"messages": 0, "replies": 0, "first_reply_after": None, "send_failures": []}
+    due_replies, retry_queue = take_due(retry_queue, "reply")
+    due_sends, retry_queue = take_due(retry_queue, "send")
+
+    async def filter_one(msgs):
+        result = await filter_emails({"messages": msgs}, ledger)
+        retry_queue.extend(result.get("retry_queue", []))
+        return result["messages"]
+
+    async def reply_batch(msgs):
+        messages = (await load_bodies({"messages": msgs}, mcp_client))["messages"]
+        result = await generate_replies({"messages": messages}, ledger, index)
+        retry_queue.extend(result.get("retry_queue", []))
+        return result["replies_to_send"]
+
+    async def send_batch(replies):
+        result = await send_replies({"replies_to_send": replies}, mcp_client, ledger, index)
+        retry_queue.extend(result.get("retry_queue", []))
+        stats["send_failures"].extend(result.get("send_failures", []))
+        stats["replies"] += len(replies)
+        if stats["first_reply_after"] is None:
+            stats["first_reply_after"] = time.time() - started
+        return []
+
+    filter_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    reply_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    send_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    filter_tasks = _start_stage("filter", filter_queue, reply_queue, STREAM_FILTER_WORKERS, filter_one)
+    filter_done, reply_done = asyncio.Event(), asyncio.Event()
+    reply_tasks = _start_stage("reply", reply_queue, send_queue, STREAM_REPLY_WORKERS, reply_batch, STREAM_BATCH_SIZE,
+                               filter_done)
+    send_tasks = _start_stage("send", send_queue, None, STREAM_SEND_WORKERS, send_batch, STREAM_BATCH_SIZE, reply_done)
+
+    try:
+        async def feed(msg):
+            stats["messages"] += 1
+            # The prefilter is local and cheap, so it runs inline in the producer
+            for kept in (await prefilter_emails({"messages": [msg]}, ledger))["messages"]:
+                await filter_queue.put(kept)
+
+        for entry in due_replies:
+            await reply_queue.put({**entry["item"], "retryAttempts": entry["attempts"]})
+        for entry in due_sends:
+            await send_queue.put({**entry["item"], "retryAttempts": entry["attempts"]})
+
+        if hasattr(messages, "__aiter__"):
+            async for msg in messages:
+                await feed(msg)
+        else:
+            for msg in messages:
+                await feed(msg)
+
+        # Stages finish in order: once a stage's queue is joined, all of its output is queued downstream
+        await _drain_stage(filter_queue, filter_tasks)
+        filter_done.set()
+        await _drain_stage(reply_queue, reply_tasks)
+        reply_done.set()
+        await _drain_stage(send_queue, send_tasks)
+    finally:
+        for task in filter_tasks + reply_tasks + send_tasks:
+            task.cancel()
+
+    first_reply = stats["first_reply_after"]
+    print(f"Stream done: {stats['messages']} message(s), {stats['replies']} reply(s) handled by send in {time.time() - started:.1f}s"
+          + (f" (first reply after {first_reply:.1f}s)" if first_reply is not None else ""))
+    stats["retry_queue"] = retry_queue
+    return stats
+
+async def run_streaming_cycle(mcp_client, state, ledger=None, index=None):
+    """One agent cycle in streaming mode. Returns the state updates, like graph.ainvoke."""
+    with metrics.span("node", metrics.NODE_SECONDS, node="fetch"):
+        fetched = await fetch_emails(state, mcp_client, ledger)
+    stats = await run_pipeline(fetched["messages"], mcp_client, ledger, fetched.get("retry_queue"), index)
+
+    result = {
+        "messages": [], "replies_to_send": [], "retry_queue": stats["retry_queue"],
+        "pending_threads": [], "backlog": fetched.get("backlog", False),
+        "send_failures": stats["send_failures"],
+        **commit_sync_point(mcp_client, fetched.get("sync_point"), stats["retry_queue"])
+    }
+    if not ledger:
+        # No ledger: same time-window dedup as send_replies
+        result["last_checked_time"] = time.time()
+    return result
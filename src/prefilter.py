@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import math
+
+# Cheap local checks that run BEFORE the LLM filter.
+# 1. Header rules: mailing lists, bulk mail and auto-replies are never customer inquiries.
+# 2. Sender allow/deny lists (env, comma separated addresses or @domains).
+# 3. A small keyword model (naive Bayes) trained from the LLM's past decisions.
+#    Only very confident predictions are used; everything else still goes to the LLM.
+
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "true").lower() == "true"
+PREFILTER_MODEL_FILE = os.getenv("PREFILTER_MODEL_FILE", "prefilter_model.json")
+PREFILTER_ALLOW_SENDERS = [s.strip().lower() for s in os.getenv("PREFILTER_ALLOW_SENDERS", "").split(",") if s.strip()]
+PREFILTER_DENY_SENDERS = [s.strip().lower() for s in os.getenv("PREFILTER_DENY_SENDERS", "").split(",") if s.strip()]
+PREFILTER_MIN_SAMPLES = int(os.getenv("PREFILTER_MIN_SAMPLES", "50")) # Decisions needed before the model is trusted
+PREFILTER_CONFIDENCE = float(os.getenv("PREFILTER_CONFIDENCE", "0.97"))
+
+# Automated senders that never need a reply
+NO_REPLY_PATTERN = re.compile(r"(no-?reply|do-?not-?reply|mailer-daemon|postmaster|notifications?@|bounce)", re.I)
+BULK_PRECEDENCE = ("bulk", "list", "junk")
+
+# Per-stage counters (process lifetime)
+STATS = {
+    "seen": 0,
+    "rejected_headers": 0,
+    "rejected_sender": 0,
+    "rejected_model": 0,
+    "accepted_model": 0,
+    "sent_to_llm": 0,
+}
+
+def sender_address(sender):
+    """Extracts the bare address from 'Name <email>'."""
+    if "<" in sender:
+        sender = sender.split("<")[1].strip(">")
+    return sender.strip().lower()
+
+def _matches(address, entries):
+    return any(address == entry or (entry.startswith("@") and address.endswith(entry)) for entry in entries)
+
+def header_rejection(headers):
+    """Returns a reason if the headers show the email is automated/bulk, else None."""
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    if "list-unsubscribe" in headers or "list-id" in headers:
+        return "mailing list"
+    if headers.get("precedence", "").strip().lower() in BULK_PRECEDENCE:
+        return f"precedence: {headers['precedence']}"
+    auto_submitted = headers.get("auto-submitted", "no").strip().lower()
+    if auto_submitted != "no":
+        return f"auto-submitted: {auto_submitted}"
+    return None
+
+class KeywordModel:
+    """Tiny multinomial naive Bayes over subject + snippet words, persisted as JSON."""
+
+    def __init__(self, path=PREFILTER_MODEL_FILE):
+        self.path = path
+        self.word_counts = {"accept": {}, "reject": {}}
+        self.doc_counts = {"accept": 0, "reject": 0}
+        self.load()
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"[a-z0-9']{3,}", text.lower())
+
+    @staticmethod
+    def text_of(msg):
+        return f"{msg.get('subject', '')} {msg.get('snippet', '')}"
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.word_counts = data["word_counts"]
+            self.doc_counts = data["doc_counts"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Could not load prefilter model {self.path}: {e}")
+
+    def save(self):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"word_counts": self.word_counts, "doc_counts": self.doc_counts}, f)
+        os.replace(tmp_file, self.path)
+
+    def learn(self, msg, accepted):
+        label = "accept" if accepted else "reject"
+        self.doc_counts[label] += 1
+        counts = self.word_counts[label]
+        for word in self.tokenize(self.text_of(msg)):
+            counts[word] = counts.get(word, 0) + 1
+
+    def predict(self, msg):
+        """Probability that the LLM would accept this email, or None while under-trained."""
+        total_docs = self.doc_counts["accept"] + self.doc_counts["reject"]
+        if total_docs < PREFILTER_MIN_SAMPLES or not all(self.doc_counts.values()):
+            return None
+
+        vocabulary = len(set(self.word_counts["accept"]) | set(self.word_counts["reject"])) or 1
+        scores = {}
+        for label in ("accept", "reject"):
+            counts = self.word_counts[label]
+            total_words = sum(counts.values())
+            score = math.log(self.doc_counts[label] / total_docs)
+            for word in self.tokenize(self.text_of(msg)):
+                score += math.log((counts.get(word, 0) + 1) / (total_words + vocabulary))
+            scores[label] = score
+
+        # Convert log scores into P(accept) without overflowing
+        diff = max(min(scores["reject"] - scores["accept"], 700), -700)
+        return 1.0 / (1.0 + math.exp(diff))
+
+_model = None
+
+def get_model(path=PREFILTER_MODEL_FILE):
+    """The process-wide keyword model; `path` only counts on the first call."""
+    global _model
+    if _model is None:
+        _model = KeywordModel(path)
+    return _model
+
+def prefilter_message(msg):
+    """Returns ("reject" | "accept" | "llm", reason) for one message."""
+    address = sender_address(msg.get("sender", ""))
+    allowed = _matches(address, PREFILTER_ALLOW_SENDERS)
+
+    if not allowed:
+        reason = header_rejection(msg.get("headers"))
+        if reason:
+            STATS["rejected_headers"] += 1
+            return "reject", reason
+        if _matches(address, PREFILTER_DENY_SENDERS) or NO_REPLY_PATTERN.search(address):
+            STATS["rejected_sender"] += 1
+            return "reject", f"sender {address}"
+
+    probability = get_model().predict(msg)
+    if probability is not None:
+        if probability >= PREFILTER_CONFIDENCE:
+            STATS["accepted_model"] += 1
+            return "accept", f"keyword model p={probability:.3f}"
+        if probability <= 1 - PREFILTER_CONFIDENCE and not allowed:
+            STATS["rejected_model"] += 1
+            return "reject", f"keyword model p={probability:.3f}"
+
+    STATS["sent_to_llm"] += 1
+    return "llm", "ambiguous"
+
+def record_decisions(decisions):
+    """Trains the keyword model with (msg, accepted) pairs decided by the LLM."""
+    if not decisions:
+        return
+    model = get_model()
+    for msg, accepted in decisions:
+        model.learn(msg, accepted)
+    try:
+        model.save()
+    except OSError as e:
+        print(f"Warning: Could not save prefilter model: {e}")
+
+def llm_calls_saved():
+    return STATS["rejected_headers"] + STATS["rejected_sender"] + STATS["rejected_model"] + STATS["accepted_model"]
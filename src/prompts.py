@@ -0,0 +1,104 @@
+import os
+import re
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from src import metrics
+
+# Prompt construction for the LLM nodes.
+# The fixed instructions live in constant system messages, so every call starts with the
+# same prefix (cacheable by the provider) and the per-email part stays small. Email content
+# is whitespace-trimmed and cut to a token budget, so the cost of one call is predictable.
+
+PROMPT_FILTER_CONTENT_TOKENS = int(os.getenv("PROMPT_FILTER_CONTENT_TOKENS", "200")) # Per email, filter prompts
+PROMPT_REPLY_CONTENT_TOKENS = int(os.getenv("PROMPT_REPLY_CONTENT_TOKENS", "800")) # Email body in reply prompts
+PROMPT_SUBJECT_TOKENS = 40
+
+FILTER_SYSTEM_PROMPT = """You are an email filter for a mobile phone store. For the email you get, decide:
+1. is_real_human: written by a real person (not marketing, spam or automated)?
+2. is_mobile_related: explicitly asking about mobile phones, buying a phone or mobile accessories?
+Answer only with JSON, no markdown:
+{"is_real_human": true/false, "is_mobile_related": true/false, "reason": "short reason"}"""
+
+FILTER_BATCH_SYSTEM_PROMPT = """You are an email filter for a mobile phone store. For EACH email you get (its id is in square brackets), decide:
+1. is_real_human: written by a real person (not marketing, spam or automated)?
+2. is_mobile_related: explicitly asking about mobile phones, buying a phone or mobile accessories?
+Answer only with a JSON array, one object per email, no markdown:
+[{"id": "<id>", "is_real_human": true/false, "is_mobile_related": true/false, "reason": "short reason"}]"""
+
+REPLY_SYSTEM_PROMPT = """You are a helpful mobile store owner answering a customer email.
+Write a professional, short and helpful reply. Do not use placeholders like [Your Name]. Sign off as 'Mobile Store Team'."""
+
+# Token usage reported by Groq, per node, since the process started
+USAGE = {}
+
+def count_tokens(text):
+    """Rough token count (~4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+def compact(text):
+    """Collapses runs of spaces and blank lines."""
+    text = re.sub(r"[ \t\r\f\v]+", " ", text or "")
+    text = re.sub(r"\s*\n\s*(\n\s*)+", "\n\n", text)
+    return text.strip()
+
+def truncate(text, max_tokens):
+    """Cuts `text` to about `max_tokens`, keeping its start and its end (questions are often last)."""
+    text = compact(text)
+    if count_tokens(text) <= max_tokens:
+        return text
+    max_chars = max_tokens * 4
+    head = text[:max_chars * 3 // 4].rsplit(" ", 1)[0]
+    tail = text[-(max_chars // 4):].split(" ", 1)[-1]
+    return f"{head} [...] {tail}"
+
+def email_block(msg, max_tokens=PROMPT_FILTER_CONTENT_TOKENS, content=None):
+    block = (
+        f"Sender: {compact(msg['sender'])}\n"
+        f"Subject: {truncate(msg['subject'], PROMPT_SUBJECT_TOKENS)}\n"
+        f"Content: {truncate(content if content is not None else msg['snippet'], max_tokens)}"
+    )
+    return block
+
+def batch_email_block(msg):
+    return f"[{msg['id']}]\n{email_block(msg)}"
+
+def filter_prompt(msg):
+    return [SystemMessage(content=FILTER_SYSTEM_PROMPT), HumanMessage(content=email_block(msg))]
+
+def filter_batch_prompt(batch):
+    emails = "\n\n".join(batch_email_block(msg) for msg in batch)
+    return [SystemMessage(content=FILTER_BATCH_SYSTEM_PROMPT), HumanMessage(content=emails)]
+
+def reply_prompt(msg, example=None):
+    """`example`: a similar answered inquiry ({"inquiry", "reply"}), given to the model as a previous turn."""
+    content = msg.get('body') or msg['snippet']
+    prompt_messages = [SystemMessage(content=REPLY_SYSTEM_PROMPT)]
+    if example:
+        prompt_messages += [HumanMessage(content=example['inquiry']), AIMessage(content=example['reply'])]
+    prompt_messages.append(HumanMessage(content=email_block(msg, PROMPT_REPLY_CONTENT_TOKENS, content)))
+    return prompt_messages
+
+def prompt_tokens(prompt_messages):
+    return sum(count_tokens(m.content) for m in prompt_messages)
+
+def record_usage(node, response, estimated_prompt_tokens):
+    """Adds one call's token usage to USAGE[node] (Groq's numbers, or our estimate if missing)."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    stats = USAGE.setdefault(node, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    prompt = usage.get("input_tokens", estimated_prompt_tokens)
+    completion = usage.get("output_tokens", count_tokens(str(response.content)))
+    stats["calls"] += 1
+    stats["prompt_tokens"] += prompt
+    stats["completion_tokens"] += completion
+    metrics.TOKENS.inc(prompt, node=node, kind="prompt")
+    metrics.TOKENS.inc(completion, node=node, kind="completion")
+
+def log_usage(node, before):
+    """Prints the tokens `node` used since `before` (a copy of its USAGE entry)."""
+    stats = USAGE.get(node)
+    if not stats or stats["calls"] == before.get("calls", 0):
+        return
+    calls = stats["calls"] - before.get("calls", 0)
+    prompt = stats["prompt_tokens"] - before.get("prompt_tokens", 0)
+    completion = stats["completion_tokens"] - before.get("completion_tokens", 0)
+    print(f"Token usage [{node}]: {calls} call(s), {prompt} prompt + {completion} completion tokens "
+          f"(total so far: {stats['prompt_tokens'] + stats['completion_tokens']})")
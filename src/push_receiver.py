@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import json
+import time
+from urllib.parse import urlsplit, parse_qs
+
+# Tiny asyncio HTTP endpoint for Gmail push notifications.
+# Gmail `users.watch` publishes to a Pub/Sub topic, and a Pub/Sub push subscription
+# POSTs an envelope like this to us:
+#   {"message": {"data": "<base64 of {"emailAddress": ..., "historyId": ...}>", ...}, "subscription": "..."}
+# A plain JSON body ({"emailAddress": ..., "historyId": ...}) is accepted too, so a local
+# stub or test can simply POST to the endpoint to trigger a cycle.
+
+class PushReceiver:
+    def __init__(self, host="0.0.0.0", port=8085, path="/gmail/push", debounce_seconds=2.0, verification_token=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.debounce_seconds = debounce_seconds
+        self.verification_token = verification_token # Optional ?token=... shared secret
+        self.last_notification = None
+        self.notification_count = 0
+        self._event = asyncio.Event()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Push receiver listening on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def wait_for_mail(self, timeout):
+        """Waits until a notification arrives (True) or `timeout` seconds pass (False).
+
+        After the first notification we wait `debounce_seconds` more, so a burst of
+        notifications results in a single graph run.
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        await asyncio.sleep(self.debounce_seconds)
+        self._event.clear()
+        return True
+
+    def notify(self, payload):
+        """Records a notification and wakes up the waiting loop."""
+        self.last_notification = payload
+        self.notification_count += 1
+        self._event.set()
+
+    # --- HTTP handling ---
+
+    @staticmethod
+    def _parse_payload(body):
+        data = json.loads(body or b'{}')
+        message = data.get('message') if isinstance(data, dict) else None
+        if isinstance(message, dict) and 'data' in message:
+            # Pub/Sub envelope: the Gmail notification is base64 encoded in message.data
+            return json.loads(base64.b64decode(message['data']))
+        return data
+
+    async def _handle(self, reader, writer):
+        status = 500
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            method, target, _ = request_line.split(' ', 2)
+
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            body = b''
+            if 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+
+            url = urlsplit(target)
+            token = parse_qs(url.query).get('token', [None])[0]
+
+            if url.path != self.path:
+                status = 404
+            elif method != 'POST':
+                status = 405
+            elif self.verification_token and token != self.verification_token:
+                status = 403
+            else:
+                try:
+                    payload = self._parse_payload(body)
+                except ValueError as e:
+                    print(f"Push receiver: invalid payload ({e})")
+                    status = 400
+                else:
+                    payload['receivedAt'] = time.time()
+                    print(f"Push notification received: {payload}")
+                    self.notify(payload)
+                    # Any 2xx acknowledges the Pub/Sub message
+                    status = 204
+        except Exception as e:
+            print(f"Push receiver: error handling request: {e}")
+            status = 400
+        finally:
+            reason = {204: 'No Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                      405: 'Method Not Allowed'}.get(status, 'Internal Server Error')
+            try:
+                writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+                await writer.drain()
+            finally:
+                writer.close()
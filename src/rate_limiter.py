@@ -0,0 +1,214 @@
+import os
+import time
+import random
+import asyncio
+from src import metrics
+
+# Shared rate limiting + retry layer for Gmail and Groq calls.
+# - Token buckets keep us under the published quotas, so we run right up to the
+#   ceiling instead of hitting 429s and error storms.
+# - Retries use jittered exponential backoff and honour Retry-After headers.
+# - A 429 also pauses the whole bucket, so other callers back off too.
+
+# Gmail per-user limit is 250 quota units/second. Method costs from the Gmail API docs.
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250"))
+GMAIL_QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.watch": 100,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.create": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.threads.get": 10,
+    "gmail.users.threads.list": 10,
+}
+DEFAULT_GMAIL_UNITS = 10
+
+# Groq limits depend on the plan and model; defaults match the free tier for llama-3.3-70b.
+GROQ_REQUESTS_PER_MINUTE = float(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30"))
+GROQ_TOKENS_PER_MINUTE = float(os.getenv("GROQ_TOKENS_PER_MINUTE", "12000"))
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = None # Created lazily, must belong to the running loop
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # A single request larger than the bucket would wait forever; let it drain the bucket instead
+        amount = min(amount, self.capacity)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # The lock makes waiters queue up in order (no starvation of big requests)
+        async with self._lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Blocks every caller for `seconds` (used when the server says we are rate limited)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# --- Error inspection (works for googleapiclient HttpError and groq/httpx errors) ---
+
+def error_status(error):
+    resp = getattr(error, "resp", None) # googleapiclient HttpError
+    if resp is not None and getattr(resp, "status", None):
+        return int(resp.status)
+    status = getattr(error, "status_code", None) # groq APIStatusError
+    if status:
+        return int(status)
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def retry_after_seconds(error):
+    """Seconds from a Retry-After header, if the error carries one."""
+    headers = None
+    if getattr(error, "resp", None) is not None:
+        headers = error.resp
+    elif getattr(error, "response", None) is not None:
+        headers = getattr(error.response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def is_retryable_error(error):
+    status = error_status(error)
+    if status is None:
+        # No HTTP status: network errors and timeouts are transient, bugs are not
+        return isinstance(error, (ConnectionError, TimeoutError, OSError)) or "timeout" in type(error).__name__.lower() \
+            or "connection" in type(error).__name__.lower()
+    return status in RETRYABLE_STATUSES
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, but never shorter than Retry-After."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+async def call_with_retry(func, name="call", buckets=(), max_attempts=RETRY_MAX_ATTEMPTS, retryable=is_retryable_error):
+    """Awaits func() and retries failures accepted by `retryable` with backoff.
+
+    On a 429 every bucket in `buckets` is paused, so concurrent callers slow down too.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            attempt += 1
+            if attempt >= max_attempts or not retryable(e):
+                raise
+            retry_after = retry_after_seconds(e)
+            delay = backoff_delay(attempt, retry_after)
+            if error_status(e) == 429:
+                for bucket in buckets:
+                    bucket.pause(delay)
+            print(f"{name} failed ({e.__class__.__name__}: {error_status(e)}), retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+            metrics.RETRIES.inc(call=name)
+            await asyncio.sleep(delay)
+
+# --- Gmail ---
+
+def gmail_request_units(request):
+    """Quota units for a googleapiclient request (batches cost the sum of their parts)."""
+    sub_requests = getattr(request, "_requests", None) # BatchHttpRequest
+    if sub_requests is not None:
+        return sum(gmail_request_units(r) for r in sub_requests.values())
+    return GMAIL_QUOTA_UNITS.get(getattr(request, "methodId", None), DEFAULT_GMAIL_UNITS)
+
+def new_gmail_bucket():
+    """One bucket per mailbox: Gmail's per-user quota."""
+    return TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+
+# --- Groq ---
+
+class GroqLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every LLM call in the process."""
+
+    def __init__(self, requests_per_minute=GROQ_REQUESTS_PER_MINUTE, tokens_per_minute=GROQ_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute / 60.0, capacity=requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, capacity=tokens_per_minute)
+
+    async def acquire(self, estimated_tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    @property
+    def buckets(self):
+        return (self.requests, self.tokens)
+
+_groq_limiter = None
+
+def get_groq_limiter():
+    global _groq_limiter
+    if _groq_limiter is None:
+        _groq_limiter = GroqLimiter()
+    return _groq_limiter
+
+# --- Re-queueing failed items ---
+# Items that still fail after retries are not dropped: they go into the state's
+# "retry_queue" and the stage that failed picks them up again in a later cycle.
+
+def queue_retry(retry_queue, stage, item, error, previous_attempts=0):
+    """Adds a failed item to the retry queue, or gives up after RETRY_MAX_ATTEMPTS cycles."""
+    attempts = previous_attempts + 1
+    if attempts >= RETRY_MAX_ATTEMPTS:
+        print(f"Giving up on {stage} item after {attempts} attempts: {error}")
+        metrics.ERRORS.inc(where=f"{stage} gave up")
+        return False
+    metrics.RETRIES.inc(call=f"requeue {stage}")
+    retry_queue.append({
+        "stage": stage,
+        "item": item,
+        "attempts": attempts,
+        "not_before": time.time() + backoff_delay(attempts, retry_after_seconds(error)),
+        "error": str(error)[:200],
+    })
+    return True
+
+def queued_ids(retry_queue):
+    """Message ids with an entry in the queue (messages carry 'id', replies 'messageId')."""
+    return {entry["item"].get("id") or entry["item"].get("messageId") for entry in retry_queue or []}
+
+def take_due(retry_queue, stage):
+    """Splits the queue into (entries of `stage` that are due now, everything else)."""
+    now = time.time()
+    due, remaining = [], []
+    for entry in retry_queue or []:
+        if entry["stage"] == stage and entry["not_before"] <= now:
+            due.append(entry)
+        else:
+            remaining.append(entry)
+    return due, remaining
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+from src import prompts
+
+try:
+    import numpy as np
+except ImportError: # Optional: without NumPy every reply is generated as before
+    np = None
+
+# Index of answered inquiries, for reusing replies to questions we already answered.
+# Customers mostly ask the same few things (stock, price, warranty). Every sent reply is
+# stored with a CPU-only embedding of the email it answered (hashed words + word pairs,
+# no model needed). In the reply stage, each new email is compared with all stored ones
+# (cosine similarity, one matrix product):
+# - nearly identical question about the same models (S24, iPhone 15): the stored reply is
+#   reused (greeting adapted), no LLM call
+# - similar question (opt-in, REPLY_EXAMPLE_SIMILARITY > 0): the stored pair goes into the
+#   prompt as an example and the reply gets a smaller token limit
+# Vectors live in a memory-mapped .npy file, the texts in a JSON file next to it. Each entry
+# keeps a checksum of its vector row, so rows that don't match the JSON after a crash (an
+# overwritten row whose entry was not saved yet) are re-embedded on load.
+
+REPLY_INDEX_ENABLED = os.getenv("REPLY_INDEX_ENABLED", "false").lower() == "true"
+REPLY_INDEX_FILE = os.getenv("REPLY_INDEX_FILE", "reply_index") # <name>.npy + <name>.json
+REPLY_INDEX_MAX_ENTRIES = int(os.getenv("REPLY_INDEX_MAX_ENTRIES", "2000")) # Oldest entries are overwritten
+REPLY_REUSE_SIMILARITY = float(os.getenv("REPLY_REUSE_SIMILARITY", "0.95"))
+# 0 = off: in the benchmark the example costs more prompt tokens than the smaller limit saves
+REPLY_EXAMPLE_SIMILARITY = float(os.getenv("REPLY_EXAMPLE_SIMILARITY", "0"))
+EMBEDDING_DIM = 1024
+INITIAL_CAPACITY = 256 # Rows; the file doubles when full (up to REPLY_INDEX_MAX_ENTRIES)
+
+GREETING_PATTERN = re.compile(r"^(hi|hello|hey|dear)\b[^,!\n]*([,!])", re.IGNORECASE)
+WORD_PATTERN = re.compile(r"[A-Za-z0-9]+")
+MIXED_PATTERN = re.compile(r"\b(?=[A-Za-z]*\d)(?=\d*[A-Za-z])[A-Za-z0-9]+\b") # S24, 5G, 128GB
+MODEL_PATTERN = re.compile(r"\b([A-Za-z]*[A-Z][A-Za-z]*) (\d{1,3})\b") # iPhone 15, Note 13
+
+def inquiry_text(msg):
+    """What gets embedded (and shown as example): subject and start of the email."""
+    content = msg.get('body') or msg.get('snippet', '')
+    return prompts.truncate(f"{msg.get('subject', '')}\n{content}", prompts.PROMPT_FILTER_CONTENT_TOKENS)
+
+def tokenize(text):
+    """Lowercase words without plain numbers (order refs, dates; model numbers come from model_tokens)."""
+    return [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 1 and not word.isdigit()]
+
+def model_tokens(text):
+    """Product/model identifiers: words mixing letters and digits, and name + number pairs."""
+    found = {word.lower() for word in MIXED_PATTERN.findall(text)}
+    found.update(f"{name.lower()} {number}" for name, number in MODEL_PATTERN.findall(text))
+    return found
+
+def can_reuse(inquiry, entry):
+    """Only reuse a stored reply if the new inquiry asks about the same models."""
+    return model_tokens(inquiry) == model_tokens(entry['inquiry'])
+
+def embed(text):
+    """L2-normalized hashed bag of words, word pairs and model tokens (stable across processes)."""
+    words = tokenize(text)
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])] + sorted(model_tokens(text)):
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[h % EMBEDDING_DIM] += 1.0 if h >> 63 else -1.0
+    vector = np.sign(vector) * np.log1p(np.abs(vector)) # Repeated words count less
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def adapt_reply(reply, sender):
+    """Points the greeting of a stored reply at the new sender ("Hi Anna," -> "Hi Tom,")."""
+    name = sender.split("<")[0].strip().strip('"').split(" ")[0] if "<" in sender else ""
+    return GREETING_PATTERN.sub(lambda m: f"{m.group(1)} {name}{m.group(2)}" if name else f"Hello{m.group(2)}",
+                                reply, count=1)
+
+class ReplyIndex:
+    def __init__(self, path=REPLY_INDEX_FILE, max_entries=REPLY_INDEX_MAX_ENTRIES):
+        self.vectors_file = path + ".npy"
+        self.entries_file = path + ".json"
+        self.max_entries = max_entries
+        self.entries = [] # {"inquiry", "reply", "crc"}, same order as the vector rows
+        self.next_row = 0 # Where the next entry goes once the index is full
+        self.vectors = None
+        self.load()
+
+    def load(self):
+        if not (os.path.exists(self.vectors_file) and os.path.exists(self.entries_file)):
+            return
+        try:
+            with open(self.entries_file, "r") as f:
+                data = json.load(f)
+            vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+            if vectors.shape[1] != EMBEDDING_DIM or len(data["entries"]) > len(vectors):
+                raise ValueError(f"unexpected shape {vectors.shape}")
+            self.vectors = vectors
+            self.entries = data["entries"]
+            self.next_row = data["next_row"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Could not load reply index {self.vectors_file}: {e}")
+            return
+        repaired = 0
+        for row, entry in enumerate(self.entries):
+            if entry.get("crc") != zlib.crc32(self.vectors[row].tobytes()):
+                self._store(row, entry["inquiry"], entry["reply"])
+                repaired += 1
+        if repaired:
+            print(f"Reply index: {repaired} row(s) did not match {self.entries_file}, re-embedded.")
+            self.save()
+
+    def _grow(self):
+        capacity = min(max(INITIAL_CAPACITY, 2 * len(self.entries)), self.max_entries)
+        tmp_file = self.vectors_file + ".tmp.npy"
+        vectors = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=(capacity, EMBEDDING_DIM))
+        if self.vectors is not None:
+            vectors[:len(self.entries)] = self.vectors[:len(self.entries)]
+        vectors.flush()
+        self.vectors = None # Drop the old mapping before the file is replaced
+        os.replace(tmp_file, self.vectors_file)
+        self.vectors = np.lib.format.open_memmap(self.vectors_file, mode="r+")
+
+    def _store(self, row, inquiry, reply):
+        self.vectors[row] = embed(inquiry)
+        self.entries[row] = {"inquiry": inquiry, "reply": reply, "crc": zlib.crc32(self.vectors[row].tobytes())}
+
+    def search(self, text):
+        """(similarity, entry) of the most similar stored inquiry, (0.0, None) if the index is empty."""
+        if not self.entries:
+            return 0.0, None
+        similarities = self.vectors[:len(self.entries)] @ embed(text)
+        best = int(np.argmax(similarities))
+        return float(similarities[best]), self.entries[best]
+
+    def add(self, pairs):
+        """Stores (inquiry, reply) pairs and saves the index. Near-duplicates of stored inquiries are skipped."""
+        added = 0
+        for inquiry, reply in pairs:
+            if self.search(inquiry)[0] >= REPLY_REUSE_SIMILARITY:
+                continue
+            if len(self.entries) < self.max_entries:
+                if self.vectors is None or len(self.entries) == len(self.vectors):
+                    self._grow()
+                row = len(self.entries)
+                self.entries.append(None)
+            else:
+                row = self.next_row # Full: overwrite the oldest entry
+                self.next_row = (row + 1) % self.max_entries
+            self._store(row, inquiry, reply)
+            added += 1
+        if added:
+            self.save()
+        return added
+
+    def save(self):
+        # Vectors first: entries beyond the saved JSON are ignored after a crash, overwritten
+        # rows are caught by the checksum in load()
+        self.vectors.flush()
+        tmp_file = self.entries_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"entries": self.entries, "next_row": self.next_row}, f)
+        os.replace(tmp_file, self.entries_file)
+
+_indexes = {} # path -> ReplyIndex
+
+def get_index(path=REPLY_INDEX_FILE):
+    """The index stored at `path` (one per mailbox), or None when disabled (or NumPy is not installed)."""
+    global REPLY_INDEX_ENABLED
+    if not REPLY_INDEX_ENABLED:
+        return None
+    if np is None:
+        print("Reply index disabled: NumPy is not installed (pip install numpy).")
+        REPLY_INDEX_ENABLED = False
+        return None
+    if path not in _indexes:
+        _indexes[path] = ReplyIndex(path)
+    return _indexes[path]